@@ -1,7 +1,28 @@
 import requests
 import json
+import os
+import re
+import sys
+import gzip
+import numpy as np
 import pandas as pd
 import urllib3
+import time
+import inspect
+import functools
+import threading
+import queue
+import contextvars
+import atexit
+import runpy
+import argparse
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from datetime import timedelta
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from requests.adapters import HTTPAdapter, BaseAdapter
+from requests.structures import CaseInsensitiveDict
 from bs4 import BeautifulSoup
 from typing import Union, Dict
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -30,13 +51,501 @@ api_url = "https://manageiq.local/api"
 username = "SomeUsername
 password = "Pass"
 
+# DEADLINES and timeouts for every API call
+
+# Timeout in seconds for requests made without a deadline
+DEFAULT_TIMEOUT = 60
+
+# Deadline of the current call, see Deadline and deadline_aware
+_current_deadline = contextvars.ContextVar('deadline', default=None)
+
+# Threads sending hedged GET requests
+_hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix='miq-hedge')
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    Raised when a request is about to be sent after its deadline expired.
+    """
+
+class Deadline:
+    """
+    Time budget shared by a call and every request it sends.
+
+    Each request may use the remaining budget except a small reserve kept for the requests that can
+    still follow it, so a fallback chain cannot spend the whole budget on its first request while a
+    healthy but slow first response is not cut short. Use it as a context manager to set
+    the deadline for every call made inside the block, or pass it as the deadline argument of any
+    MIQ_migrate function.
+
+    Args:
+        budget (float): Time budget in seconds.
+        parts (int): Maximal number of requests sharing the budget.
+        hedge_after (float): Send a second copy of a GET still running after this many seconds
+                             and use whichever response comes first. None disables hedging.
+        min_timeout (float): Minimal timeout in seconds given to a request while the budget allows it.
+    """
+
+    def __init__(self, budget: float, parts: int = 1, hedge_after: float = None, min_timeout: float = 0.5):
+        self.budget = float(budget)
+        self.expires = time.monotonic() + self.budget
+        self.parts = max(1, int(parts))
+        self.used = 0
+        self.hedge_after = hedge_after
+        self.min_timeout = min_timeout
+        self.lock = threading.Lock()
+        self.tokens = []
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+    def next_timeout(self) -> float:
+        """
+        Return the timeout for the next request: the remaining budget minus a reserve of min_timeout
+        for each request that may follow it, the reserve being at most a quarter of the remaining budget.
+
+        Raises:
+            DeadlineExceeded: If the budget is already spent.
+
+        >>> round(Deadline(4, parts=6).next_timeout(), 1)
+        3.0
+        >>> round(Deadline(10, parts=3).next_timeout(), 1)
+        9.0
+        >>> round(Deadline(4).next_timeout(), 1)
+        4.0
+        """
+        with self.lock:
+            parts_left = max(1, self.parts - self.used)
+            self.used += 1
+
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(f"Deadline of {self.budget}s exceeded")
+
+        reserve = min(self.min_timeout * (parts_left - 1), remaining / 4)
+        return min(remaining, max(remaining - reserve, self.min_timeout))
+
+    def split(self, parts: int) -> 'Deadline':
+        """
+        Return a deadline with the same expiry time shared by parts requests.
+        """
+        child = Deadline(self.budget, parts=parts, hedge_after=self.hedge_after, min_timeout=self.min_timeout)
+        child.expires = self.expires
+        return child
+
+    def __enter__(self):
+        self.tokens.append(_current_deadline.set(self))
+        return self
+
+    def __exit__(self, *exc):
+        _current_deadline.reset(self.tokens.pop())
+        return False
+
+    def __repr__(self):
+        return f"Deadline(remaining={self.remaining():.2f}s, parts={self.parts}, used={self.used})"
+
+def current_deadline() -> Deadline:
+    """
+    Return the deadline set for the current call, or None.
+    """
+    return _current_deadline.get()
+
+def deadline_aware(func=None, parts: int = 1):
+    """
+    Decorator adding the deadline argument to a function.
+
+    deadline may be a Deadline or a budget in seconds. Without it the ambient deadline set by an
+    outer call or a 'with Deadline(...)' block is used. The deadline is shared by at most parts
+    requests, the number of requests the function may send in its fallback chain.
+    """
+    if func is None:
+        return lambda f: deadline_aware(f, parts=parts)
+
+    @functools.wraps(func)
+    def wrapper(*args, deadline: Union['Deadline', float] = None, **kwargs):
+        if deadline is None:
+            deadline = current_deadline()
+        elif not isinstance(deadline, Deadline):
+            deadline = Deadline(deadline)
+
+        if deadline is None:
+            return func(*args, **kwargs)
+
+        with deadline.split(parts):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+def run_in_context(func):
+    """
+    Wrap func so it runs with the deadline (and other context) of the calling thread, e.g. in a thread pool.
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+
+    return wrapper
+
+# Session with response cache and request coalescing (single-flight) for GETs
+
+# Latency samples kept per endpoint in MIQSession.timings
+TIMING_SAMPLES = 500
+
+def endpoint_key(url: str) -> str:
+    """
+    Return the endpoint of an api url with resource ids replaced, e.g. 'vms/:id' for '.../api/vms/42?expand=tags'
+    or 'vms?filter' for '.../api/vms?filter[]=name=...'.
+    """
+    split = urlsplit(str(url))
+    segments = [seg for seg in split.path.split('/') if seg]
+    if 'api' in segments:
+        segments = segments[segments.index('api') + 1:]
+
+    key = '/'.join(':id' if seg.isdigit() else seg for seg in segments)
+    if 'filter' in split.query:
+        key += '?filter'
+
+    return key
+
+def _resource_root(url: str) -> str:
+    # '.../api/vms/42/tags' -> '.../api/vms/42', '.../api/vms?filter...' -> '.../api/vms'
+    split = urlsplit(str(url))
+    segments = split.path.rstrip('/').split('/')
+    if 'api' in segments:
+        segments = segments[:segments.index('api') + 3]
+
+    return f"{split.scheme}://{split.netloc}{'/'.join(segments)}"
+
+class _CacheEntry:
+    """
+    A cached GET response with its expiry time and validators.
+    """
+    def __init__(self, response: requests.Response, ttl: float):
+        self.response = response
+        self.size = len(response.content or b'')
+        self.expires = time.monotonic() + ttl
+        self.validators = {}
+
+        if response.headers.get('ETag'):
+            self.validators['If-None-Match'] = response.headers['ETag']
+        if response.headers.get('Last-Modified'):
+            self.validators['If-Modified-Since'] = response.headers['Last-Modified']
+
+    def fresh(self) -> bool:
+        return time.monotonic() < self.expires
+
+class ResponseCache:
+    """
+    LRU cache of GET responses capped by number of entries and bytes.
+
+    Every endpoint has its own TTL (see endpoint_key). Expired entries with an ETag or
+    Last-Modified header are revalidated with a conditional GET instead of being downloaded again.
+    Writes (POST/PUT/PATCH/DELETE) invalidate the targeted resource and its subresources.
+    Name lookups that found nothing are not cached, so polling for a VM that is still being
+    discovered after vMotion sees it as soon as it appears.
+
+    Args:
+        max_entries (int): Maximum number of cached responses.
+        max_bytes (int): Maximum total size of cached response bodies.
+        ttls (dict): TTL in seconds per endpoint, merged with DEFAULT_TTLS.
+        default_ttl (float): TTL for endpoints missing from ttls.
+    """
+
+    DEFAULT_TTLS = {
+        'users/:id': 300,
+        'tenants': 300,
+        'tenants?filter': 300,
+        'tenants/:id/quotas': 10,
+        'vms?filter': 30,
+        'vms/:id': 30,
+        'services?filter': 30,
+        'services/:id': 30,
+    }
+
+    def __init__(self, max_entries: int = 2048, max_bytes: int = 64 * 1024 * 1024, ttls: dict = None, default_ttl: float = 30):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttls = {**self.DEFAULT_TTLS, **(ttls or {})}
+        self.default_ttl = default_ttl
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        # Every invalidation gets a generation, the recent ones are kept to reject responses of GETs racing them
+        self.generation = 0
+        self.invalidations = deque(maxlen=256)
+
+    def ttl(self, url: str) -> float:
+        return self.ttls.get(endpoint_key(url), self.default_ttl)
+
+    def get(self, url: str):
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+            return entry
+
+    def put(self, url: str, response: requests.Response, generation: int = None):
+        """
+        Cache a GET response. With the generation at which the GET started, the response is dropped
+        when a write invalidated the url while the GET was in flight.
+        """
+        ttl = self.ttl(url)
+        if ttl <= 0 or response.status_code != 200:
+            return
+
+        if endpoint_key(url).endswith('?filter'):
+            try:
+                if not response.json().get('resources'):
+                    return
+            except (ValueError, AttributeError):
+                return
+
+        entry = _CacheEntry(response, ttl)
+        if entry.size > self.max_bytes:
+            return
+
+        with self.lock:
+            if generation is not None and generation < self.generation:
+                # Older than the invalidations still remembered, it may be stale
+                if not self.invalidations or self.invalidations[0][0] > generation + 1:
+                    return
+                if any(number > generation and self._matches(url, roots, collections)
+                       for number, roots, collections in self.invalidations):
+                    return
+
+            self._pop(url)
+            self.entries[url] = entry
+            self.bytes += entry.size
+
+            # Evict least recently used entries
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._pop(next(iter(self.entries)))
+
+    def refresh(self, url: str, entry: _CacheEntry):
+        with self.lock:
+            entry.expires = time.monotonic() + self.ttl(url)
+
+    def _pop(self, url: str):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    def invalidate(self, url: str, data=None):
+        """
+        Drop cached responses of the resource targeted by a write, its subresources and its collection queries.
+        """
+        root = _resource_root(url)
+        roots = {root}
+
+        # Bulk actions posted to a collection target the resources listed in the body
+        if isinstance(data, (str, bytes)):
+            try:
+                data = json.loads(data)
+            except ValueError:
+                data = None
+        if isinstance(data, dict):
+            if data.get('action') == 'query':
+                return
+            hrefs = {_resource_root(r['href']) for r in data.get('resources') or [] if isinstance(r, dict) and r.get('href')}
+            if hrefs and not endpoint_key(root).endswith(':id'):
+                roots = hrefs
+
+        # Collection queries such as '.../api/vms?filter[]=...' may list the changed resources
+        collections = {collection_url(r) if endpoint_key(r).endswith(':id') else r for r in roots | {root}}
+
+        with self.lock:
+            self.generation += 1
+            self.invalidations.append((self.generation, roots, collections))
+            for key in list(self.entries):
+                if self._matches(key, roots, collections):
+                    self._pop(key)
+
+    @staticmethod
+    def _matches(url: str, roots: set, collections: set) -> bool:
+        path = url.split('?')[0].rstrip('/')
+        return path in collections or any(path == root or path.startswith(root + '/') for root in roots)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+class _Flight:
+    """
+    A GET request in progress, shared by every caller asking for the same url.
+    """
+    def __init__(self, generation: int = 0):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+        # Cache generation when the request started, see ResponseCache.put
+        self.generation = generation
+
+class MIQSession(requests.Session):
+    """
+    requests Session with a transparent GET response cache and request coalescing.
+
+    Parallel workers often ask for the same url at the same moment (the same owner in get_user,
+    the same tenant in get_tenant_uri/get_tenant_quota, the full collection fallback in get_vm_url).
+    Only the first caller goes to the wire, the others wait for its response.
+    Cached responses are reused until their TTL expires; send 'Cache-Control: no-cache' to bypass the cache.
+    The module session caches only with MIQ_CACHE=1, the manifest command turns it on for its run.
+    Counters in `stats` show how many requests were sent and how many were saved,
+    `timings` keeps the latest latency and size samples of the requests sent per (method, endpoint).
+
+    Args:
+        cache (bool or ResponseCache): Response cache to use, True for the default one, False to disable.
+    """
+
+    def __init__(self, cache: Union[bool, 'ResponseCache'] = True):
+        super().__init__()
+        self.inflight = {}
+        self.inflight_lock = threading.Lock()
+        self.stats = {'sent': 0, 'coalesced': 0, 'cache_hits': 0, 'revalidated': 0, 'hedged': 0}
+        self.timings = {}
+        self.cache = ResponseCache() if cache is True else (cache or None)
+
+    @staticmethod
+    def _flight_key(method: str, url: str, kwargs: dict):
+        # Requests with different query params or headers are different requests
+        params = kwargs.get('params')
+        headers = kwargs.get('headers')
+        return (method, str(url), repr(params), repr(sorted(headers.items())) if headers else None)
+
+    def _count(self, counter: str):
+        with self.inflight_lock:
+            self.stats[counter] += 1
+
+    def request(self, method, url, *args, **kwargs):
+        method = str(method).upper()
+
+        if method != 'GET' or kwargs.get('stream'):
+            self._count('sent')
+            try:
+                return self._send(method, url, *args, **kwargs)
+            finally:
+                if self.cache is not None and method in ('POST', 'PUT', 'PATCH', 'DELETE'):
+                    self.cache.invalidate(str(url), kwargs.get('json') or kwargs.get('data'))
+
+        if self.cache is None or kwargs.get('params'):
+            return self._single_flight(method, url, *args, **kwargs)
+
+        url = str(url)
+        headers = dict(kwargs.get('headers') or {})
+        entry = None if 'no-cache' in str(headers.get('Cache-Control', '')) else self.cache.get(url)
+
+        if entry is not None and entry.fresh():
+            self._count('cache_hits')
+            return entry.response
+
+        if entry is not None and entry.validators:
+            kwargs['headers'] = {**headers, **entry.validators}
+
+        flight = self._flight(method, url, *args, **kwargs)
+        response = flight.response
+
+        if response.status_code == 304 and entry is not None:
+            self._count('revalidated')
+            self.cache.refresh(url, entry)
+            return entry.response
+
+        self.cache.put(url, response, flight.generation)
+        return response
+
+    def _single_flight(self, method, url, *args, **kwargs):
+        return self._flight(method, url, *args, **kwargs).response
+
+    def _flight(self, method, url, *args, **kwargs) -> _Flight:
+        key = self._flight_key(method, url, kwargs)
+
+        with self.inflight_lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight(self.cache.generation if self.cache is not None else 0)
+                self.stats['sent'] += 1
+            else:
+                self.stats['coalesced'] += 1
+
+        if not leader:
+            deadline = current_deadline()
+            if not flight.done.wait(deadline.remaining() if deadline else None):
+                raise DeadlineExceeded(f"Deadline exceeded waiting for {url}")
+            if flight.error is not None:
+                raise flight.error
+            return flight
+
+        try:
+            flight.response = self._send(method, url, *args, **kwargs)
+            return flight
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self.inflight_lock:
+                del self.inflight[key]
+            flight.done.set()
+
+    def _send(self, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        response = self._transmit(method, url, *args, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        body = kwargs.get('data') or kwargs.get('json') or b''
+        size = int(response.headers.get('Content-Length') or 0) if kwargs.get('stream') else len(response.content or b'')
+        sample = (elapsed, size, len(body if isinstance(body, (str, bytes)) else json.dumps(body)))
+        with self.inflight_lock:
+            self.timings.setdefault((method, endpoint_key(url)), deque(maxlen=TIMING_SAMPLES)).append(sample)
+        return response
+
+    def _transmit(self, method, url, *args, **kwargs):
+        # Every request on the wire gets a timeout from the deadline or DEFAULT_TIMEOUT
+        deadline = current_deadline()
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = deadline.next_timeout() if deadline else DEFAULT_TIMEOUT
+
+        send = functools.partial(super().request, method, url, *args, **kwargs)
+        if method != 'GET' or deadline is None or deadline.hedge_after is None or kwargs['timeout'] <= deadline.hedge_after:
+            return send()
+
+        # Hedging: a GET still running after hedge_after gets a second copy, the first response wins
+        done, pending = wait({_hedge_pool.submit(send)}, timeout=deadline.hedge_after)
+        if not done:
+            self._count('hedged')
+            pending.add(_hedge_pool.submit(send))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+        first = done.pop()
+        if first.exception() is not None and pending:
+            return pending.pop().result()
+        return first.result()
+
+    def print_stats(self):
+        """
+        Print how many requests were sent to the wire and how many were served by the cache or by coalescing.
+        """
+        with self.inflight_lock:
+            stats = dict(self.stats)
+
+        saved = stats['coalesced'] + stats['cache_hits'] + stats['revalidated']
+        total = stats['sent'] + stats['coalesced'] + stats['cache_hits']
+        saved_pct = (saved / total * 100) if total else 0
+        print(f"Requests sent: {color.BOLD}{stats['sent']}{color.END} Coalesced: {color.GREEN}{stats['coalesced']}{color.END} "
+              f"Cache hits: {color.GREEN}{stats['cache_hits']}{color.END} Revalidated: {color.GREEN}{stats['revalidated']}{color.END} Hedged: {color.YELLOW}{stats['hedged']}{color.END} "
+              f"Saved: {color.GREEN}{saved_pct:.1f}%{color.END}")
+
 # Connect to ManageIQ API
-session = requests.Session()
+session = MIQSession(cache=os.environ.get('MIQ_CACHE', '').lower() in ('1', 'true', 'yes'))
 session.auth = (username, password)
 session.verify = False
 
 # Delete service using URL
 
+@deadline_aware
 def delete_service(url: str, session: requests.Session = session):
     """
     Delete a service or VM based on the provided URL using the specified requests Session.
@@ -64,6 +573,7 @@ def delete_service(url: str, session: requests.Session = session):
         print(f"Error deleting {url}: {e}")
         return None
 
+@deadline_aware
 def update_description(url: str, desc: str, session: requests.Session = session) -> requests.Response:
     """
     Update the description using a POST request.
@@ -89,6 +599,7 @@ def update_description(url: str, desc: str, session: requests.Session = session)
         print(f"Error updating description: {e}")
         return None
 
+@deadline_aware
 def assign_tag(url: str, vmtype: str, category: str = 'vmtype', session: requests.Session = session):
     """
     Assign a tag to a VM or service.
@@ -148,6 +659,7 @@ def assign_tag(url: str, vmtype: str, category: str = 'vmtype', session: request
 
     return assign_tag_response
     
+@deadline_aware
 def get_vm_hardware(url: str, session: requests.Session = session):
     """
     Get the VM hardware details.
@@ -202,6 +714,7 @@ def get_vm_hardware(url: str, session: requests.Session = session):
         "size": size_gb
     }
 
+@deadline_aware(parts=6)
 def get_vm_url(name: str, state: str = 'on', api_url: str = api_url, session: requests.Session = session):
     """
     Get the URL for a virtual machine based on its name and state.
@@ -483,6 +996,7 @@ def get_vm_url(name: str, state: str = 'on', api_url: str = api_url, session: re
         print(f"VM resource with name {vm_name} with state {state.upper()} doesn't exist!!!")
         return 1
         
+@deadline_aware
 def get_vm_tags(url: str, session: requests.Session = session) -> Dict[str, Union[Dict[str, str], Dict[str, str], str, str]]:
     """
     Get tags for a VM object from its URL.
@@ -514,12 +1028,7 @@ def get_vm_tags(url: str, session: requests.Session = session) -> Dict[str, Unio
     # Initialize dict to keep vm tags info
     vm_tags = {}
     
-    for i in tags_data['tags']:
-        #tag_list = []
-        # Convert tags separated by / to the list
-        tag_list = i['name'].replace("/managed/", '').split("/")
-        # Add tag key and value to the dictionary
-        vm_tags[tag_list[0]] = tag_list[1]
+    vm_tags.update(tags_to_dict(tags_data['tags']))
 
     for key, value in vm_tags.items():
         if key == 'vmtype':
@@ -546,6 +1055,7 @@ def get_vm_tags(url: str, session: requests.Session = session) -> Dict[str, Unio
 
     return {"tags":vm_tags, "data": tags_data, "desc": tags_data['description'], "vmtype": vm_tags['vmtype']}
     
+@deadline_aware(parts=6)
 def get_service_url_tags(vm_resource_name: str, api_url: str = api_url, session: requests.Session = session):
     """
     Get tags for a VM object from its name.
@@ -678,7 +1188,7 @@ def get_service_url_tags(vm_resource_name: str, api_url: str = api_url, session:
 
     user_id = service_tags_data['evm_owner_id']
     if len(user_id) > 0:
-        user_info = get_user(user_id)
+        user_info = get_user(user_id, api_url=api_url, session=session)
     else: 
         print(color.BOLD + color.RED + "user_id contains empty value!!!\n" + color.END)
 
@@ -694,6 +1204,7 @@ def get_service_url_tags(vm_resource_name: str, api_url: str = api_url, session:
     return {'url': service_resource_url, 'tags': service_tags_data['tags'], 'data': service_tags_data, 'user': user_info}
 
 
+@deadline_aware
 def get_user(user_id: str, api_url: str = api_url, session: requests.Session = session):
     
     """
@@ -720,10 +1231,52 @@ def get_user(user_id: str, api_url: str = api_url, session: requests.Session = s
     return user_name
 
 # QUOTA GET and UPDATE functions
+
+# Locks serializing updates of the same quota href, updates of other quotas run in parallel
+quota_locks = {}
+quota_locks_lock = threading.Lock()
+
+def quota_lock(url: str) -> threading.Lock:
+    """
+    Return the lock serializing read-modify-write updates of a quota href.
+    """
+    with quota_locks_lock:
+        return quota_locks.setdefault(str(url), threading.Lock())
+
+def _write_quota(url: str, delta: float, session: requests.Session = session):
+    """
+    Add delta to the current value of a quota while holding its lock.
+
+    The value is re-read right before the write (bypassing the response cache), so deltas applied
+    by parallel workers since the uri_dict snapshot was taken are not lost.
+    """
+    with quota_lock(url):
+        try:
+            current = session.get(str(url), headers={'Cache-Control': 'no-cache'})
+            current.raise_for_status()
+            value_ = float(current.json()['value']) + delta
+            if isinstance(delta, int):
+                value_ = int(value_)
+        except (requests.exceptions.RequestException, ValueError, KeyError) as e:
+            print(f"Error reading current quota value {url}: {e}")
+            return None
+
+        service_headers = { 'Content-Type': 'application/json'}
+        update_data = { "action": "edit",  
+                        "resource" : {
+                                    "value":f"{value_}"
+                                    }}
+
+        return session.post(str(url), data=json.dumps(update_data), headers=service_headers), value_
+
+@deadline_aware(parts=6)
 def update_quota(uri_dict, cpu=0, memory=0, storage=0, operation: str = 'add', session: requests.Session = session):
     
     """
     Update resource quotas based on the provided URI dictionary and resource adjustments.
+
+    The current value of every quota is re-read under a per-quota lock before it is written,
+    so parallel workers updating the same tenant do not overwrite each other's changes.
     
     Args:
         uri_dict (dict): A dictionary containing URIs for different resources.
@@ -737,57 +1290,32 @@ def update_quota(uri_dict, cpu=0, memory=0, storage=0, operation: str = 'add', s
         list: A list of responses from the POST requests made during quota updates.
     """
     result = []
+    sign = -1 if 'sub' in operation else 1
     
     for i in uri_dict:
-        flag = False
-        value_ = ''
-
         if i == 'storage' and storage != 0:
-            if 'sub' in operation:
-                value_gb = uri_dict[i]['storage_gb'] - float(storage)
-            else:
-                value_gb = uri_dict[i]['storage_gb'] + float(storage)
-
-            print("Storage new value :", value_gb, "GB")
-            value_ = value_gb * (1024*1024*1024)
-            url = uri_dict[i]['storage_uri']
-            flag = True
+            url, delta, name, unit = uri_dict[i]['storage_uri'], sign * float(storage) * (1024*1024*1024), "Storage", "GB"
 
         elif i == 'memory' and memory != 0:
-            if 'sub' in operation:
-                value_gb = uri_dict[i]['memory_gb'] - float(memory)
-            else:
-                value_gb = uri_dict[i]['memory_gb'] + float(memory)
-
-            print("Memory new value :", value_gb, "GB")
-            value_ = value_gb * (1024*1024*1024)
-            url = uri_dict[i]['memory_uri']
-            flag = True
+            url, delta, name, unit = uri_dict[i]['memory_uri'], sign * float(memory) * (1024*1024*1024), "Memory", "GB"
             
         elif i == 'cpu' and cpu != 0:
-            if 'sub' in operation:
-                value_ = int(uri_dict[i]['cpu_count']) - int(cpu)
-            else:
-                value_ = int(uri_dict[i]['cpu_count']) + int(cpu)
+            url, delta, name, unit = uri_dict[i]['cpu_uri'], sign * int(cpu), "CPU", "cores"
 
-            print("CPU new value :", value_, "cores")
+        else:
+            continue
 
-            url = uri_dict[i]['cpu_uri']
-            flag = True
+        written = _write_quota(url, delta, session=session)
+        if written is None:
+            continue
 
-        service_headers = { 'Content-Type': 'application/json'}
-        update_data = { "action": "edit",  
-                        "resource" : {
-                                    "value":f"{value_}"
-                                    }}
-    
-        if flag:
-            update_quota = session.post(str(url), data=json.dumps(update_data), headers=service_headers)
-            flag = False
-            result.append(update_quota)
+        update_quota, value_ = written
+        print(f"{name} new value :", value_ / (1024*1024*1024) if unit == "GB" else int(value_), unit)
+        result.append(update_quota)
 
     return result
 
+@deadline_aware
 def get_tenant_uri(ci_name: str, api_url: str = api_url, session: requests.Session = session):
 
     """
@@ -816,6 +1344,7 @@ def get_tenant_uri(ci_name: str, api_url: str = api_url, session: requests.Sessi
 
     return uri
 
+@deadline_aware
 def get_tenant_quota(tenant_uri: str, session: requests.Session = session):
 
     """
@@ -863,6 +1392,7 @@ def get_tenant_quota(tenant_uri: str, session: requests.Session = session):
 
     return {'storage': {'name': 'storage_allocated', 'storage_gb': storage, 'storage_uri': storage_uri}, 'memory': {'name': 'mem_allocated', 'memory_gb': memory, 'memory_uri': memory_uri}, 'cpu':  {'name': 'cpu_allocated', 'cpu_count': cpu, 'cpu_uri': cpu_uri}}
 
+@deadline_aware
 def get_vm_os(url: str, session: requests.Session = session):
     """
     Retrieve the operating system information for a given VM resource URL.
@@ -898,6 +1428,7 @@ def get_vm_os(url: str, session: requests.Session = session):
 
 # Checking if service attached to VM and updating attached service name
 
+@deadline_aware
 def get_vm_service(url: str, session: requests.Session = session):
     """
     Get a service attached to the VM based on the provided URL using the specified requests Session.
@@ -939,6 +1470,7 @@ def get_vm_service(url: str, session: requests.Session = session):
 
     return {"data": svc_data, "svc_details": svc_data['service'], "svc_name": svc_data['service']['name'], "id": svc_data['service']['id'], 'vm_name': vm_name}
 
+@deadline_aware
 def update_service_name(service_id: Union[int, str], vm_name: str, api_url: str = api_url, session: requests.Session = session):
 
     """
@@ -981,3 +1513,2262 @@ def update_service_name(service_id: Union[int, str], vm_name: str, api_url: str
         print("Request got timeout on server!")
         return None
 
+# MULTI-REGION client registry
+
+class MIQRegion:
+    """
+    Connection details for a single ManageIQ region.
+
+    Every region keeps its own requests Session (and therefore its own connection pool),
+    its own lookup cache and its own concurrency limit.
+
+    Args:
+        api_url (str): The api endpoint url in the format 'https://manageiq.test.com/api'
+        username (str): ManageIQ user name for the region.
+        password (str): ManageIQ password for the region.
+        max_workers (int): Maximum number of concurrent requests sent to the region.
+        session (requests.Session): Optional existing session to reuse instead of creating a new one,
+                                    its connection pool is left unchanged.
+    """
+
+    def __init__(self, api_url: str, username: str = None, password: str = None, max_workers: int = 8, session: requests.Session = None):
+        self.api_url = str(api_url).rstrip('/')
+        self.max_workers = max(1, int(max_workers))
+
+        # A session passed in is used as is, its adapters belong to the caller
+        if session is None:
+            session = MIQSession()
+            session.auth = (username, password)
+            session.verify = False
+
+            # One keep-alive connection per worker of the region
+            adapter = HTTPAdapter(pool_connections=self.max_workers, pool_maxsize=self.max_workers)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+
+        self.session = session
+        self.cache = {}
+        self.cache_lock = threading.Lock()
+        self.limit = threading.BoundedSemaphore(self.max_workers)
+
+    def cached(self, key, fetch):
+        """
+        Return the cached value for key, calling fetch() only on the first lookup.
+        """
+        with self.cache_lock:
+            if key in self.cache:
+                return self.cache[key]
+
+        value = fetch()
+
+        with self.cache_lock:
+            return self.cache.setdefault(key, value)
+
+    def __repr__(self):
+        return f"MIQRegion({self.api_url!r}, max_workers={self.max_workers})"
+
+# Registered regions by api_url
+regions = {}
+regions_lock = threading.Lock()
+
+def register_region(api_url: str, username: str = None, password: str = None, max_workers: int = 8, session: requests.Session = None) -> MIQRegion:
+    """
+    Register a ManageIQ region so batch operations can route requests to it.
+
+    Args:
+        api_url (str): The api endpoint url in the format 'https://manageiq.test.com/api'
+        username (str): ManageIQ user name for the region.
+        password (str): ManageIQ password for the region.
+        max_workers (int): Maximum number of concurrent requests sent to the region.
+        session (requests.Session): Optional existing session for the region.
+
+    Returns:
+        MIQRegion: The registered region.
+    """
+    region = MIQRegion(api_url, username, password, max_workers=max_workers, session=session)
+
+    with regions_lock:
+        regions[region.api_url] = region
+
+    print(f"Region registered: {color.CYAN}{region.api_url}{color.END} with {color.BOLD}{region.max_workers}{color.END} workers")
+    return region
+
+def get_region(url: str) -> MIQRegion:
+    """
+    Find the registered region for an api_url or for any href that belongs to it.
+    The region of the module level api_url and session is registered on first use.
+
+    Args:
+        url (str): The api endpoint url or a resource href, e.g. 'https://manageiq.test.com/api/vms/1'
+
+    Returns:
+        MIQRegion: The region owning the url.
+
+    Raises:
+        KeyError: If no registered region matches the url.
+    """
+    url = str(url).rstrip('/')
+
+    with regions_lock:
+        if url in regions:
+            return regions[url]
+
+        # Longest api_url prefix wins, so 'https://a/api' never captures 'https://a/api2/...'
+        matches = [r for key, r in regions.items() if url.startswith(key + '/') or url.startswith(key + '?')]
+
+    if not matches:
+        default = str(api_url).rstrip('/')
+        if url == default or url.startswith(default + '/') or url.startswith(default + '?'):
+            with regions_lock:
+                registered = regions.get(default)
+            return registered or register_region(default, session=session)
+        raise KeyError(f"No region registered for url {url}")
+
+    return max(matches, key=lambda r: len(r.api_url))
+
+def run_by_region(func, items: list, memoize: bool = False, deadline: float = None) -> list:
+    """
+    Run one of the MIQ_migrate functions for a batch of items, routing every item to its region.
+
+    Items of the same region share the region session and respect its concurrency limit,
+    while different regions run in parallel, so a cross-region wave takes as long as the
+    slowest region rather than the sum of all of them.
+
+    Args:
+        func (callable): Function to run, e.g. get_vm_url or get_vm_tags.
+        items (list): List of (url, arg) tuples. url is the region api_url or any href of the region,
+                      arg is the first argument of func (a tuple is unpacked into several arguments).
+        memoize (bool): Reuse the result for identical (hashable) arguments within a region.
+        deadline (float): Time budget in seconds for every item, see Deadline.
+                          Without it the deadline of the caller, if any, applies to the whole batch.
+
+    Returns:
+        list: Results in the same order as items. A failed call returns the raised exception.
+    """
+    results = [None] * len(items)
+    by_region = {}
+
+    for index, (url, arg) in enumerate(items):
+        by_region.setdefault(get_region(url), []).append((index, arg))
+
+    takes_api_url = 'api_url' in inspect.signature(func).parameters
+
+    def run_region(region, jobs):
+        kwargs = {'session': region.session}
+        if takes_api_url:
+            kwargs['api_url'] = region.api_url
+
+        def call(job):
+            index, arg = job
+            args = arg if isinstance(arg, tuple) else (arg,)
+
+            def invoke():
+                if deadline is None:
+                    return func(*args, **kwargs)
+                with Deadline(deadline):
+                    return func(*args, **kwargs)
+
+            with region.limit:
+                try:
+                    if memoize:
+                        results[index] = region.cached((func.__name__, args), invoke)
+                    else:
+                        results[index] = invoke()
+                except Exception as e:
+                    print(f"Error running {func.__name__} for {color.BLUE}{arg}{color.END} in region {region.api_url}: {color.RED}{e}{color.END}")
+                    results[index] = e
+
+        with ThreadPoolExecutor(max_workers=region.max_workers) as pool:
+            list(pool.map(run_in_context(call), jobs))
+
+    with ThreadPoolExecutor(max_workers=max(1, len(by_region))) as pool:
+        futures = [pool.submit(run_in_context(run_region), region, jobs) for region, jobs in by_region.items()]
+        for future in futures:
+            future.result()
+
+    return results
+
+# BATCHED reads and tag synchronisation
+
+# Number of resources sent in a single bulk action request
+BATCH_SIZE = 100
+
+def tags_to_dict(tags: list) -> Dict[str, str]:
+    """
+    Convert ManageIQ tag resources to a dictionary.
+
+    Parameters:
+    - tags (list): Tag resources as returned by the 'tags' attribute, e.g. [{'name': '/managed/location/b7'}].
+
+    Returns:
+    - Dict[str, str]: Dictionary of tag category and value, e.g. {'location': 'b7'}.
+    """
+    result = {}
+
+    for i in tags or []:
+        # Convert tags separated by / to the list
+        tag_list = str(i['name']).replace("/managed/", '').split("/")
+        if len(tag_list) > 1:
+            result[tag_list[0]] = tag_list[1]
+
+    return result
+
+def collection_url(href: str) -> str:
+    """
+    Return the collection url of a resource href, e.g. '.../api/vms' for '.../api/vms/42'.
+    """
+    return str(href).split('?')[0].rstrip('/').rsplit('/', 1)[0]
+
+@deadline_aware
+def bulk_action(action: str, resources: list, session: requests.Session = session, attributes: str = '', collection: str = None) -> list:
+    """
+    Send a bulk action for resources, one POST per collection and per BATCH_SIZE resources.
+
+    Parameters:
+    - action (str): The action name, e.g. 'query', 'assign_tags', 'edit' or 'delete'.
+    - resources (list): Resource dictionaries containing at least the 'href' key.
+    - session (requests.Session): The session object.
+    - attributes (str): Attributes to expand for the 'query' action, e.g. 'tags,service'.
+    - collection (str): Collection url for resources without href, e.g. for the 'create' action.
+
+    Returns:
+    - list: Results returned by the API, batch after batch. A failed batch contributes
+            {'success': False, 'href': href} for each of its resources.
+    """
+    by_collection = {}
+    for resource in resources:
+        by_collection.setdefault(collection or collection_url(resource['href']), []).append(resource)
+
+    results = []
+    service_headers = {'Content-Type': 'application/json'}
+
+    for collection_href, items in by_collection.items():
+        url = f"{collection_href}?expand=resources&attributes={attributes}" if attributes else collection_href
+
+        for start in range(0, len(items), BATCH_SIZE):
+            chunk = items[start:start + BATCH_SIZE]
+            update_data = {"action": action, "resources": chunk}
+
+            try:
+                response = session.post(url, data=json.dumps(update_data), headers=service_headers)
+                response.raise_for_status()
+                results.extend(response.json().get('results', []))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                print(f"Error running bulk {action} on {collection_href}: {e}")
+                results.extend({'success': False, 'href': resource.get('href')} for resource in chunk)
+
+    return results
+
+@deadline_aware
+def bulk_query(hrefs: list, attributes: str = '', session: requests.Session = session) -> Dict[str, dict]:
+    """
+    Read many resources with batched 'query' actions instead of one GET per resource.
+
+    Parameters:
+    - hrefs (list): Resource hrefs, e.g. VM and service urls.
+    - attributes (str): Attributes to expand, e.g. 'tags' or 'service,evm_owner_id'.
+    - session (requests.Session): The session object.
+
+    Returns:
+    - Dict[str, dict]: Dictionary of href and resource data. Resources that could not be read are missing.
+    """
+    by_collection = {}
+    for href in dict.fromkeys(str(h) for h in hrefs if h):
+        by_collection.setdefault(collection_url(href), []).append(href)
+
+    # bulk_action keeps this collection order and the order of resources within each collection
+    ordered = [href for group in by_collection.values() for href in group]
+    results = bulk_action('query', [{'href': h} for h in ordered], session=session, attributes=attributes)
+
+    return {href: data for href, data in zip(ordered, results) if data and data.get('success') is not False}
+
+def _tag_changes(desired: Dict[str, str], current: Dict[str, str]) -> tuple:
+    """
+    Compare the desired tags of one resource with the tags it already has.
+
+    Empty current values are not assignments - get_vm_tags reports an untagged vmtype as '' - so
+    they are never unassigned. A None or empty desired value removes the category.
+
+    Parameters:
+    - desired (Dict[str, str]): Desired tags by category.
+    - current (Dict[str, str]): Tags already assigned by category.
+
+    Returns:
+    - tuple: The (to_assign, to_unassign) lists of {"category": ..., "name": ...} dictionaries.
+
+    >>> _tag_changes({'vmtype': 'cloud'}, {'location': 'b7', 'vmtype': ''})
+    ([{'category': 'vmtype', 'name': 'cloud'}], [])
+    >>> _tag_changes({'location': 'B8'}, {'location': 'b7'})
+    ([{'category': 'location', 'name': 'b8'}], [{'category': 'location', 'name': 'b7'}])
+    >>> _tag_changes({'location': 'b7', 'vmtype': None}, {'location': 'B7', 'vmtype': ''})
+    ([], [])
+    """
+    assigned = {str(k).lower(): str(v).lower() for k, v in (current or {}).items() if v}
+    to_assign = []
+    to_unassign = []
+
+    for category, value in desired.items():
+        category = str(category).lower()
+        old_value = assigned.get(category)
+        new_value = str(value).lower() if value else None
+
+        if old_value == new_value:
+            continue
+        if old_value is not None:
+            to_unassign.append({"category": category, "name": old_value})
+        if new_value is not None:
+            to_assign.append({"category": category, "name": new_value})
+
+    return to_assign, to_unassign
+
+@deadline_aware(parts=3)
+def sync_tags(desired: Dict[str, Dict[str, str]], current: Dict[str, Dict[str, str]] = None, session: requests.Session = session) -> dict:
+    """
+    Bring tags of many VMs and services to the desired state with the minimal number of writes.
+
+    The desired tags are compared with the tags already assigned and only the missing assignments
+    and the stale values are sent, batched per collection. Running it twice costs zero tag writes.
+
+    Parameters:
+    - desired (Dict[str, Dict[str, str]]): Dictionary of VM or service href and desired tags,
+      e.g. {'.../api/vms/42': {'location': 'b7', 'vmtype': 'cloud'}}. A None value removes the category.
+    - current (Dict[str, Dict[str, str]]): Tags already fetched, e.g. get_vm_tags(url)['tags']
+      or tags_to_dict(service['tags']). Hrefs missing here are read with bulk_query.
+    - session (requests.Session): The session object.
+
+    Returns:
+    - dict: Dictionary with the number of 'assigned' and 'unassigned' tags and the 'failed' hrefs.
+    """
+    current = dict(current or {})
+
+    missing = [href for href in desired if href not in current]
+    if missing:
+        for href, data in bulk_query(missing, 'tags', session=session).items():
+            current[href] = tags_to_dict(data.get('tags'))
+
+    assign = []
+    unassign = []
+
+    for href, tags in desired.items():
+        if href not in current:
+            print(f"Tags for {color.BLUE}{href}{color.END} could not be read - " + color.RED + "SKIPPED" + color.END)
+            continue
+
+        to_assign, to_unassign = _tag_changes(tags, current[href])
+
+        if to_unassign:
+            unassign.append({"href": href, "tags": to_unassign})
+        if to_assign:
+            assign.append({"href": href, "tags": to_assign})
+
+    failed = set()
+
+    for action, resources in (('unassign_tags', unassign), ('assign_tags', assign)):
+        # Tag actions return one result per tag, carrying the href of the tagged resource
+        for result in bulk_action(action, resources, session=session):
+            if result.get('success') is False:
+                failed.add(str(result.get('href')))
+
+    summary = {
+        'assigned': sum(len(r['tags']) for r in assign if r['href'] not in failed),
+        'unassigned': sum(len(r['tags']) for r in unassign if r['href'] not in failed),
+        'failed': sorted(failed),
+    }
+
+    print(f"Tags assigned: {color.GREEN}{summary['assigned']}{color.END} Unassigned: {color.YELLOW}{summary['unassigned']}{color.END} Failed: {color.RED}{len(failed)}{color.END}")
+    return summary
+
+# BULK service recreation for migrated VMs
+
+def _failed(results: list) -> set:
+    """
+    Return hrefs of the failed bulk action results.
+    """
+    return {str(r.get('href')) for r in results if r.get('success') is False}
+
+@deadline_aware(parts=8)
+def recreate_services(vms: list, mode: str = 'reparent', session: requests.Session = session, journal: 'Journal' = None) -> list:
+    """
+    Move the services of archived VMs onto the VMs discovered after vMotion, in batches.
+
+    For every VM the service of the archived VM becomes the service of the new VM:
+    - 'reparent' mode adds the new VM to the archived VM's service and removes the archived VM from it.
+    - 'create' mode creates a new service with the description, owner and tags of the archived VM's
+       service, adds the new VM to it and deletes the archived service.
+    A service that the new VM got on discovery is deleted as orphan. When the archived VM has no
+    service the existing service of the new VM is kept, otherwise an empty service is created.
+    Every target service is renamed with the "VM - NAME" convention.
+    Reads and writes are batched with bulk_query/bulk_action.
+
+    Args:
+        vms (list): List of (vm_name, archived_vm_href, new_vm_href) tuples.
+        mode (str): 'reparent' (default) or 'create'.
+        session (requests.Session): An existing requests Session object for making HTTP requests.
+        journal (Journal): Checkpoint journal, VMs whose service was already recreated are skipped
+                           and their recorded rows returned.
+
+    Returns:
+        list: Dictionaries with 'vm_name', 'archived_href', 'vm_href', 'service_href', 'source_href',
+              'action' ('reparented', 'created' or 'renamed'), 'orphans' and 'success' keys.
+    """
+    if mode not in ('reparent', 'create'):
+        print(f"Unknown mode {mode} for service recreation!")
+        return []
+
+    resumed = []
+    if journal is not None:
+        for vm_name, old, new in vms:
+            row = journal.done(vm_name, 'recreate_service', {'archived_href': str(old), 'vm_href': str(new), 'mode': mode})
+            if row is not None:
+                resumed.append(row)
+        done = {r['vm_name'] for r in resumed}
+        vms = [vm for vm in vms if vm[0] not in done]
+        if resumed:
+            print(f"Services already recreated: {color.YELLOW}{len(resumed)}{color.END}")
+        if not vms:
+            return resumed
+
+    # Services attached to archived and new VMs
+    vm_data = bulk_query([h for _, old, new in vms for h in (old, new)], 'name,service', session=session)
+
+    def service_href(vm_href):
+        service = (vm_data.get(str(vm_href)) or {}).get('service')
+        if not service:
+            return ''
+        # VM href '.../api/vms/42' -> '.../api/services/<id>'
+        return service.get('href') or f"{collection_url(collection_url(vm_href))}/services/{service['id']}"
+
+    old_services = {str(old): service_href(old) for _, old, _ in vms}
+    new_services = {str(new): service_href(new) for _, _, new in vms}
+
+    services = {}
+    if mode == 'create':
+        services = bulk_query([h for h in old_services.values() if h], 'name,description,evm_owner_id,tags', session=session)
+
+    plan = []
+    for vm_name, old, new in vms:
+        old, new = str(old), str(new)
+        old_svc, new_svc = old_services[old], new_services[new]
+        row = {'vm_name': vm_name, 'archived_href': old, 'vm_href': new, 'service_href': '', 'source_href': old_svc,
+               'action': 'created', 'orphans': [], 'success': True}
+
+        if old_svc and mode == 'reparent':
+            row.update(service_href=old_svc, action='reparented')
+        elif old_svc:
+            row['orphans'].append(old_svc)
+        elif new_svc:
+            row.update(service_href=new_svc, action='renamed')
+
+        # Service the new VM got on discovery
+        if new_svc and new_svc != old_svc and row['action'] != 'renamed':
+            row['orphans'].append(new_svc)
+
+        plan.append(row)
+
+    # Create the new services with the description, owner and tags of the archived ones
+    to_create = [r for r in plan if r['action'] == 'created']
+    if to_create:
+        api_url_ = collection_url(collection_url(to_create[0]['vm_href']))
+        resources = [{"name": f"VM - {str(r['vm_name']).upper()}",
+                      "description": (services.get(r['source_href']) or {}).get('description') or str(r['vm_name'])} for r in to_create]
+
+        for row, result in zip(to_create, bulk_action('create', resources, session=session, collection=f"{api_url_}/services")):
+            if result.get('success') is False or not (result.get('href') or result.get('id')):
+                row['success'] = False
+            else:
+                row['service_href'] = result.get('href') or f"{api_url_}/services/{result['id']}"
+
+        owners = []
+        desired_tags = {}
+        for row in to_create:
+            source = services.get(row['source_href'])
+            if not row['success'] or not source:
+                continue
+            if source.get('evm_owner_id'):
+                owners.append({"href": row['service_href'], "owner": {"href": f"{api_url_}/users/{source['evm_owner_id']}"}})
+            desired_tags[row['service_href']] = tags_to_dict(source.get('tags'))
+
+        failed = _failed(bulk_action('set_ownership', owners, session=session))
+        if desired_tags:
+            failed |= set(sync_tags(desired_tags, current={h: {} for h in desired_tags}, session=session)['failed'])
+
+        for row in to_create:
+            if row['service_href'] in failed:
+                row['success'] = False
+
+    ready = [r for r in plan if r['success']]
+
+    # Attach new VMs, detach archived VMs from reparented services and rename the services not created above
+    attach = [{"href": r['service_href'], "resource": {"href": r['vm_href']}} for r in ready if r['action'] != 'renamed']
+    detach = [{"href": r['service_href'], "resource": {"href": r['archived_href']}} for r in ready if r['action'] == 'reparented']
+    renames = [{"href": r['service_href'], "name": f"VM - {str(r['vm_name']).upper()}"} for r in ready if r['action'] != 'created']
+
+    failed = set()
+    for action, resources in (('add_resource', attach), ('remove_resource', detach), ('edit', renames)):
+        failed |= _failed(bulk_action(action, resources, session=session))
+
+    for row in ready:
+        if row['service_href'] in failed:
+            row['success'] = False
+
+    # Delete orphans only when their VM moved successfully and no other VM uses them
+    targets = {r['service_href'] for r in plan}
+    orphans = sorted({h for r in plan if r['success'] for h in r['orphans'] if h not in targets})
+    failed = _failed(bulk_action('delete', [{"href": h} for h in orphans], session=session))
+
+    for row in plan:
+        if row['success']:
+            print(f"{color.BOLD}{color.GREEN}{row['vm_name']}{color.END} service {row['action']}: {color.BLUE}{row['service_href']}{color.END}")
+        else:
+            print(f"{color.BOLD}{color.RED}{row['vm_name']}{color.END} service recreation " + color.RED + "FAILED" + color.END + "!")
+
+    print(f"Services recreated: {color.GREEN}{sum(r['success'] for r in plan)}{color.END} of {len(plan)}, orphans deleted: {color.YELLOW}{len(set(orphans) - failed)}{color.END}")
+
+    if journal is not None:
+        for row in plan:
+            if row['success']:
+                journal.record(row['vm_name'], 'recreate_service', {**row, 'orphans': [h for h in row['orphans'] if h in orphans and h not in failed]},
+                               inputs={'archived_href': row['archived_href'], 'vm_href': row['vm_href'], 'mode': mode})
+        journal.flush()
+    return resumed + plan
+
+# RECORD and replay of API traffic for offline performance regression tests
+
+# Keys whose values are replaced in recorded request and response bodies
+SCRUB_KEYS = re.compile(r'pass(word)?|token|secret|auth', re.IGNORECASE)
+
+# Response headers kept in a cassette
+CASSETTE_HEADERS = ('Content-Type', 'ETag', 'Last-Modified')
+
+class PerformanceRegression(AssertionError):
+    """
+    Raised when a replayed run sends more requests, reads more bytes or takes longer than its baseline.
+    """
+
+def _scrub(data):
+    # Replace credentials in decoded JSON bodies
+    if isinstance(data, dict):
+        return {k: '***' if SCRUB_KEYS.search(str(k)) else _scrub(v) for k, v in data.items()}
+    if isinstance(data, list):
+        return [_scrub(v) for v in data]
+    return data
+
+def _scrub_body(body) -> str:
+    if body is None:
+        return ''
+    if isinstance(body, bytes):
+        body = body.decode('utf-8', 'replace')
+    try:
+        return json.dumps(_scrub(json.loads(body)), sort_keys=True)
+    except ValueError:
+        return body
+
+def _scrub_url(url: str) -> str:
+    # Drop user:password@ from the url
+    split = urlsplit(str(url))
+    return split._replace(netloc=split.netloc.rsplit('@', 1)[-1]).geturl()
+
+class Cassette:
+    """
+    Requests and responses recorded during a real run, stored as gzipped JSON lines.
+
+    Every entry keeps the method, url and body of the request and the status, headers, body
+    and latency of the response. Credentials are scrubbed before they are stored.
+    """
+
+    def __init__(self, entries: list = None):
+        self.entries = list(entries or [])
+        self.lock = threading.Lock()
+
+    def add(self, request: requests.PreparedRequest, response: requests.Response, elapsed: float):
+        headers = {k: response.headers[k] for k in CASSETTE_HEADERS if k in response.headers}
+        entry = {'m': request.method, 'u': _scrub_url(request.url), 'b': _scrub_body(request.body),
+                 's': response.status_code, 'h': headers, 'c': _scrub_body(response.content), 't': round(elapsed, 4)}
+        with self.lock:
+            self.entries.append(entry)
+
+    def save(self, path: str):
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+        print(f"Cassette saved: {color.BLUE}{path}{color.END} with {color.BOLD}{len(self.entries)}{color.END} requests")
+
+    @classmethod
+    def load(cls, path: str) -> 'Cassette':
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return cls(json.loads(line) for line in f if line.strip())
+
+class RecordingAdapter(HTTPAdapter):
+    """
+    HTTPAdapter adding every request and response it sends to a cassette.
+    """
+
+    def __init__(self, cassette: Cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        response = super().send(request, *args, **kwargs)
+        self.cassette.add(request, response, time.perf_counter() - start)
+        return response
+
+class ReplayAdapter(BaseAdapter):
+    """
+    Transport serving responses from a cassette with the recorded latencies instead of the network.
+
+    Identical requests get their recorded responses in order, the last one is repeated when the
+    run sends a request more often than the recording. A request missing from the cassette raises
+    ConnectionError, so new requests show up as failures.
+
+    Args:
+        cassette (Cassette): The recorded traffic.
+        speed (float): Latency multiplier, 0 replays without waiting.
+    """
+
+    def __init__(self, cassette: Cassette, speed: float = 1.0):
+        super().__init__()
+        self.speed = speed
+        self.responses = {}
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'bytes': 0, 'missing': 0}
+
+        for entry in cassette.entries:
+            self.responses.setdefault((entry['m'], entry['u'], entry['b']), deque()).append(entry)
+
+    def send(self, request, *args, **kwargs):
+        key = (request.method, _scrub_url(request.url), _scrub_body(request.body))
+
+        with self.lock:
+            self.stats['requests'] += 1
+            recorded = self.responses.get(key)
+            if not recorded:
+                self.stats['missing'] += 1
+                raise requests.exceptions.ConnectionError(f"No recorded response for {request.method} {request.url}", request=request)
+            entry = recorded.popleft() if len(recorded) > 1 else recorded[0]
+            self.stats['bytes'] += len(entry['c'])
+
+        if self.speed:
+            time.sleep(entry['t'] * self.speed)
+
+        response = requests.Response()
+        response.status_code = entry['s']
+        response.headers = CaseInsensitiveDict(entry['h'])
+        response._content = entry['c'].encode('utf-8')
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.elapsed = timedelta(seconds=entry['t'])
+        return response
+
+    def close(self):
+        pass
+
+def _swap_adapters(session: requests.Session, adapter: BaseAdapter) -> dict:
+    old = dict(session.adapters)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return old
+
+def _restore_adapters(session: requests.Session, adapters: dict):
+    session.adapters.clear()
+    for prefix, adapter in adapters.items():
+        session.mount(prefix, adapter)
+
+@contextmanager
+def record(path: str, session: requests.Session = session):
+    """
+    Record every request sent through the session inside the block into a cassette file.
+
+    The session response cache is cleared first, so responses cached before the block are sent
+    again and recorded, and the cassette replays the same requests as the recorded run.
+
+    Args:
+        path (str): Cassette file path, e.g. 'wave42.cassette.gz'.
+        session (requests.Session): The session object.
+    """
+    cassette = Cassette()
+    current = session.get_adapter('https://')
+    pool_size = getattr(current, '_pool_maxsize', 10)
+    adapters = _swap_adapters(session, RecordingAdapter(cassette, pool_connections=pool_size, pool_maxsize=pool_size))
+    cache = getattr(session, 'cache', None)
+    if cache is not None:
+        cache.clear()
+
+    try:
+        yield cassette
+    finally:
+        _restore_adapters(session, adapters)
+        cassette.save(path)
+
+@contextmanager
+def replay(path: str, session: requests.Session = session, speed: float = 1.0):
+    """
+    Serve every request sent through the session inside the block from a cassette file.
+
+    Args:
+        path (str): Cassette file path.
+        session (requests.Session): The session object.
+        speed (float): Latency multiplier, 0 replays without waiting.
+    """
+    adapter = ReplayAdapter(Cassette.load(path), speed=speed)
+    adapters = _swap_adapters(session, adapter)
+    cache = getattr(session, 'cache', None)
+    if cache is not None:
+        cache.clear()
+
+    try:
+        yield adapter
+    finally:
+        _restore_adapters(session, adapters)
+
+def replay_benchmark(run, cassette: str, baseline: str, tolerance: float = 0.1, update: bool = False,
+                     session: requests.Session = session, speed: float = 1.0) -> dict:
+    """
+    Replay a run offline and compare its request count, bytes and wall time with a stored baseline.
+
+    Args:
+        run (callable): Function running the workload, e.g. lambda: get_vm_url('vm01').
+        cassette (str): Cassette file recorded with record().
+        baseline (str): JSON file with the baseline metrics. It is created when missing.
+        tolerance (float): Allowed relative increase of every metric, 0.1 means 10%.
+        update (bool): Store the metrics of this run as the new baseline.
+        session (requests.Session): The session the workload uses.
+        speed (float): Latency multiplier, 0 replays without waiting.
+
+    Returns:
+        dict: Metrics of the run: 'requests', 'bytes', 'wall_s' and 'missing'.
+
+    Raises:
+        PerformanceRegression: If a metric is worse than baseline * (1 + tolerance).
+    """
+    with replay(cassette, session=session, speed=speed) as adapter:
+        start = time.perf_counter()
+        run()
+        wall = time.perf_counter() - start
+
+    metrics = {'requests': adapter.stats['requests'], 'bytes': adapter.stats['bytes'], 'wall_s': round(wall, 4), 'missing': adapter.stats['missing']}
+    print(f"Replay: requests {color.BOLD}{metrics['requests']}{color.END} bytes {color.BOLD}{metrics['bytes']}{color.END} wall {color.BOLD}{metrics['wall_s']}s{color.END} missing {color.RED}{metrics['missing']}{color.END}")
+
+    if update or not os.path.exists(baseline):
+        with open(baseline, 'w') as f:
+            json.dump(metrics, f, indent=2)
+        print(f"Baseline saved: {color.BLUE}{baseline}{color.END}")
+        return metrics
+
+    with open(baseline) as f:
+        expected = json.load(f)
+
+    regressions = [f"{key}: {metrics[key]} > {expected[key]} (+{tolerance:.0%})"
+                   for key in ('requests', 'bytes', 'wall_s') if key in expected and metrics[key] > expected[key] * (1 + tolerance)]
+    if metrics['missing'] > expected.get('missing', 0):
+        regressions.append(f"missing: {metrics['missing']} requests not in the cassette")
+
+    if regressions:
+        for line in regressions:
+            print(color.BOLD + color.RED + "REGRESSION " + color.END + line)
+        raise PerformanceRegression("; ".join(regressions))
+
+    print(color.BOLD + color.GREEN + "No regression against baseline" + color.END)
+    return metrics
+
+# PROFILING hooks, enabled with MIQ_PROFILE=1 or the --profile flag
+
+# Run log of the command line run, profiling results are written next to it
+RUN_LOG = os.environ.get('MIQ_RUN_LOG', 'MIQ_migrate_run.log')
+
+# VM the current call works on, see profile_vm
+_current_vm = contextvars.ContextVar('vm', default=None)
+
+# Parameters naming the VM a profiled function works on, used outside of a profile_vm block
+PROFILE_VM_PARAMS = ('name', 'vm_name', 'vm_resource_name')
+
+class profile_vm:
+    """
+    Context manager attributing every profiled call inside the block to a VM.
+    """
+    def __init__(self, vm_name: str):
+        self.vm_name = str(vm_name)
+        self.tokens = []
+
+    def __enter__(self):
+        self.tokens.append(_current_vm.set(self.vm_name))
+        return self
+
+    def __exit__(self, *exc):
+        _current_vm.reset(self.tokens.pop())
+        return False
+
+class Profiler:
+    """
+    Records wall and CPU time of every call of the wrapped functions and samples the stacks of
+    the threads running them into a speedscope flame graph.
+
+    Args:
+        interval (float): Stack sampling interval in seconds.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.calls = []
+        self.active = {}
+        self.frames = {}
+        self.samples = {}
+        self.lock = threading.Lock()
+        self.running = False
+        self.sampler = None
+        self.started = None
+
+    def start(self):
+        self.running = True
+        self.started = time.perf_counter()
+        self.sampler = threading.Thread(target=self._sample_loop, name='miq-profiler', daemon=True)
+        self.sampler.start()
+
+    def stop(self):
+        self.running = False
+        if self.sampler is not None:
+            self.sampler.join()
+
+    def _frame(self, code) -> int:
+        key = (code.co_name, code.co_filename, code.co_firstlineno)
+        index = self.frames.get(key)
+        if index is None:
+            index = self.frames[key] = len(self.frames)
+        return index
+
+    def _sample_loop(self):
+        # Only threads inside a profiled call are sampled, idle pool workers are skipped
+        while self.running:
+            with self.lock:
+                active = [tid for tid, depth in self.active.items() if depth > 0]
+
+            frames = sys._current_frames()
+            for tid in active:
+                frame = frames.get(tid)
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    key = (tid, tuple(reversed(stack)))
+                    self.samples[key] = self.samples.get(key, 0) + 1
+
+            time.sleep(self.interval)
+
+    def wrap(self, func):
+        """
+        Return func wrapped to record its wall and CPU time per VM.
+
+        Calls are attributed to the VM of the enclosing profile_vm block, else to the value of the
+        first PROFILE_VM_PARAMS parameter of func, else to no VM.
+        """
+        try:
+            params = list(inspect.signature(func).parameters)
+        except (TypeError, ValueError):
+            params = []
+        vm_param = next((param for param in PROFILE_VM_PARAMS if param in params), None)
+        vm_index = params.index(vm_param) if vm_param else None
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tid = threading.get_ident()
+            vm = _current_vm.get()
+            token = None
+            if vm is None and vm_param is not None:
+                value = kwargs[vm_param] if vm_param in kwargs else args[vm_index] if vm_index < len(args) else None
+                if value is not None:
+                    token = _current_vm.set(vm := str(value))
+
+            with self.lock:
+                depth = self.active.get(tid, 0)
+                self.active[tid] = depth + 1
+
+            wall, cpu = time.perf_counter(), time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+                with self.lock:
+                    self.active[tid] -= 1
+                    self.calls.append({'vm': vm, 'function': func.__name__, 'depth': depth, 'wall_s': wall, 'cpu_s': cpu})
+                if token is not None:
+                    _current_vm.reset(token)
+
+        wrapper.__profiled__ = func
+        return wrapper
+
+    def steps(self) -> pd.DataFrame:
+        """
+        Return the per-VM step breakdown: calls, wall, CPU and waiting (network and I/O) time per function.
+        """
+        with self.lock:
+            calls = pd.DataFrame(self.calls, columns=['vm', 'function', 'depth', 'wall_s', 'cpu_s'])
+
+        steps = calls.groupby(['vm', 'function', 'depth'], dropna=False).agg(
+            calls=('wall_s', 'size'), wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum')).reset_index()
+        steps['wait_s'] = (steps['wall_s'] - steps['cpu_s']).clip(lower=0)
+
+        return steps.sort_values(['vm', 'depth', 'wall_s'], ascending=[True, True, False])
+
+    def speedscope(self) -> dict:
+        """
+        Return the sampled stacks in the speedscope file format, one profile per thread.
+        """
+        frames = [{'name': name, 'file': file, 'line': line} for (name, file, line) in self.frames]
+        names = {t.ident: t.name for t in threading.enumerate()}
+        profiles = {}
+
+        for (tid, stack), count in self.samples.items():
+            profile = profiles.setdefault(tid, {'type': 'sampled', 'name': names.get(tid, str(tid)), 'unit': 'seconds',
+                                                'startValue': 0, 'endValue': 0, 'samples': [], 'weights': []})
+            profile['samples'].append(list(stack))
+            profile['weights'].append(count * self.interval)
+            profile['endValue'] += count * self.interval
+
+        return {'$schema': 'https://www.speedscope.app/file-format-schema.json', 'shared': {'frames': frames},
+                'profiles': list(profiles.values()), 'name': os.path.basename(RUN_LOG), 'exporter': 'MIQ_migrate'}
+
+    def write(self, run_log: str = None):
+        """
+        Write '<run log>.steps.csv' and '<run log>.speedscope.json' next to the run log.
+        """
+        base = os.path.splitext(run_log or RUN_LOG)[0]
+
+        self.steps().to_csv(f"{base}.steps.csv", index=False)
+        with open(f"{base}.speedscope.json", 'w') as f:
+            json.dump(self.speedscope(), f)
+
+        print(f"Profile written: {color.BLUE}{base}.steps.csv{color.END} {color.BLUE}{base}.speedscope.json{color.END}")
+
+# Active profiler, see enable_profiling
+profiler = None
+
+# Functions taking a session that are not API calls or pipeline steps, never profiled
+PROFILE_SKIP = ('register_region', 'record', 'replay', 'replay_benchmark', 'request_costs', 'plan_manifest')
+
+def enable_profiling(interval: float = 0.005) -> Profiler:
+    """
+    Wrap every public function sending API requests (the ones taking a session) with the profiler,
+    except the PROFILE_SKIP ones.
+
+    Args:
+        interval (float): Stack sampling interval in seconds.
+
+    Returns:
+        Profiler: The active profiler.
+    """
+    global profiler
+    if profiler is not None:
+        return profiler
+
+    profiler = Profiler(interval)
+    module = sys.modules[__name__]
+
+    for name, func in list(vars(module).items()):
+        if name.startswith('_') or name in PROFILE_SKIP or not inspect.isfunction(func) or func.__module__ != __name__:
+            continue
+        if 'session' in inspect.signature(func).parameters:
+            setattr(module, name, profiler.wrap(func))
+
+    profiler.start()
+    return profiler
+
+def disable_profiling(write: bool = True):
+    """
+    Restore the original functions, stop sampling and write the profile next to the run log.
+    """
+    global profiler
+    if profiler is None:
+        return
+
+    module = sys.modules[__name__]
+    for name, func in list(vars(module).items()):
+        if hasattr(func, '__profiled__'):
+            setattr(module, name, func.__profiled__)
+
+    active, profiler = profiler, None
+    active.stop()
+    if write:
+        active.write()
+
+# PREFETCH of dependent resources after VM resolution
+
+class Prefetcher:
+    """
+    Fires the predictable follow-up GETs of a VM reconcile concurrently as soon as their inputs are known.
+
+    The requests use exactly the urls of get_vm_hardware, get_vm_tags,
+    get_service_url_tags, get_user, get_tenant_uri and get_tenant_quota, so when those functions
+    run later their responses come from the session response cache, or from the in-flight request
+    when it is still running. The reconcile critical path becomes VM href -> service -> owner
+    instead of one request after the other.
+
+    Args:
+        api_url (str): The api endpoint url in the format 'https://manageiq.test.com/api'
+        session (MIQSession): Session with a response cache shared with the later steps.
+        max_workers (int): Maximum number of prefetch requests running at the same time.
+    """
+
+    def __init__(self, api_url: str = api_url, session: requests.Session = session, max_workers: int = 16):
+        if getattr(session, 'cache', None) is None:
+            print(color.WARNING + "Prefetching without a response cache only warms up in-flight requests!" + color.END)
+
+        self.api_url = api_url
+        self.session = session
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='miq-prefetch')
+        self.lock = threading.Lock()
+        self.stats = {'issued': 0, 'failed': 0}
+
+    def _count(self, counter: str):
+        with self.lock:
+            self.stats[counter] += 1
+
+    def _get(self, url: str, then=None):
+        # GET url in the background and pass the decoded data to then()
+        def fetch():
+            # Prefetches do not spend the deadline of the step that queued them, they run with DEFAULT_TIMEOUT
+            _current_deadline.set(None)
+            try:
+                response = self.session.get(url)
+                response.raise_for_status()
+                data = response.json()
+            except (requests.exceptions.RequestException, ValueError):
+                self._count('failed')
+                return None
+
+            if then is not None:
+                then(data)
+            return data
+
+        self._count('issued')
+        return self.pool.submit(run_in_context(fetch))
+
+    def prefetch(self, vm_name: str = None, vm_href: str = None, tenant: str = None):
+        """
+        Prefetch everything that can be derived from the VM name, href and tenant known so far.
+
+        Args:
+            vm_name (str): VM name, prefetches the service "VM - NAME", its tags and owner.
+            vm_href (str): VM href, prefetches hardware and tags of the VM.
+            tenant (str): Tenant (CI) name, prefetches the tenant and its quotas.
+        """
+        if vm_href:
+            for attributes in ('hardware,disks', 'tags'):
+                self._get(f"{vm_href}?expand=resources&attributes={attributes}")
+
+        if vm_name:
+            self._get(f"{self.api_url}/services?filter[]=name='VM - {vm_name}'", functools.partial(self._service, str(vm_name)))
+
+        if tenant:
+            self._get(f"{self.api_url}/tenants?expand=resources&attributes=name&filter[]=name={str(tenant)}", self._tenant)
+
+    def _service(self, vm_name: str, data: dict):
+        resources = data.get('resources') or []
+
+        # get_service_url_tags retries with the capitalized VM name
+        if not resources and vm_name != vm_name.upper():
+            self._get(f"{self.api_url}/services?filter[]=name='VM - {vm_name.upper()}'", functools.partial(self._service, vm_name.upper()))
+        elif len(resources) == 1:
+            self._get(f"{resources[0]['href']}?expand=tags", self._owner)
+
+    def _owner(self, data: dict):
+        if data.get('evm_owner_id'):
+            self._get(f"{self.api_url}/users/{str(data['evm_owner_id'])}")
+
+    def _tenant(self, data: dict):
+        resources = data.get('resources') or []
+        if resources:
+            self._get(f"{str(resources[0]['href'])}/quotas?expand=resources&attributes=name,value,unit,used,available,total")
+
+    def close(self):
+        self.pool.shutdown(wait=False, cancel_futures=True)
+        print(f"Prefetch requests: {color.BOLD}{self.stats['issued']}{color.END} failed: {color.RED}{self.stats['failed']}{color.END}")
+
+# CHECKPOINT journal of completed steps, so an interrupted wave resumes where it stopped
+
+class Journal:
+    """
+    Append-only JSON lines journal of the steps completed for every VM.
+
+    Every line is {"ts": ..., "vm": ..., "step": ..., "input": {...}, "data": {...}}, a later line
+    for the same VM and step replaces an earlier one. Opening an existing journal loads it, so a
+    rerun knows which steps are done and gets their results (resolved hrefs, snapshots) back
+    without asking the API again. A step counts as done only for the same input, e.g. a quota
+    delta recorded for 'add' is applied again when the manifest row says 'sub' now.
+    A line cut short by a crash is ignored.
+
+    Lines are written right away but fsync'ed in batches. Steps that must not run twice
+    (quota deltas, service recreation) are recorded with sync=True and fsync'ed before the
+    next step starts. Losing a batched line only means repeating an idempotent step.
+
+    Args:
+        path (str): Journal file path.
+        batch (int): fsync after so many lines.
+        interval (float): fsync when the oldest unsynced line is older than so many seconds.
+        readonly (bool): Only load the journal, e.g. for a dry run. The file is neither created nor written.
+    """
+
+    def __init__(self, path: str, batch: int = 50, interval: float = 1.0, readonly: bool = False):
+        self.path = str(path)
+        self.readonly = readonly
+        self.batch = batch
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.steps = {}
+        self.pending = 0
+        self.synced = time.monotonic()
+        self.stats = {'loaded': 0, 'recorded': 0, 'skipped': 0, 'fsyncs': 0}
+
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.steps.setdefault(entry['vm'], {})[entry['step']] = (entry.get('input'), entry['data'])
+                        self.stats['loaded'] += 1
+                    except (ValueError, KeyError, TypeError):
+                        continue
+
+        self.file = None if readonly else open(self.path, 'a', encoding='utf-8')
+
+    @staticmethod
+    def _normalize(inputs):
+        # Inputs as they read back from a journal line
+        return None if inputs is None else json.loads(json.dumps(inputs, default=str))
+
+    def done(self, vm: str, step: str, inputs: dict = None) -> Union[dict, None]:
+        """
+        Return the data recorded for a completed step of a VM, None when the step did not complete
+        or completed with other inputs.
+        """
+        inputs = self._normalize(inputs)
+        with self.lock:
+            recorded = self.steps.get(str(vm), {}).get(step)
+            if recorded is None or recorded[0] != inputs:
+                return None
+            self.stats['skipped'] += 1
+            return recorded[1]
+
+    def record(self, vm: str, step: str, data: dict = None, inputs: dict = None, sync: bool = False):
+        """
+        Record a completed step of a VM.
+
+        Args:
+            vm (str): VM name.
+            step (str): Step name, e.g. 'resolve' or 'quota:cpu'.
+            data (dict): JSON serializable results of the step.
+            inputs (dict): JSON serializable inputs the step ran with, see done().
+            sync (bool): fsync right away instead of in a batch.
+        """
+        if self.readonly:
+            raise ValueError(f"Journal {self.path} is read-only")
+
+        data = data or {}
+        inputs = self._normalize(inputs)
+        line = json.dumps({'ts': round(time.time(), 3), 'vm': str(vm), 'step': step, 'input': inputs, 'data': data}, default=str)
+
+        with self.lock:
+            self.steps.setdefault(str(vm), {})[step] = (inputs, data)
+            self.file.write(line + '\n')
+            self.file.flush()
+            self.pending += 1
+            self.stats['recorded'] += 1
+
+            if sync or self.pending >= self.batch or time.monotonic() - self.synced >= self.interval:
+                self._fsync()
+
+    def _fsync(self):
+        if self.pending:
+            os.fsync(self.file.fileno())
+            self.stats['fsyncs'] += 1
+        self.pending = 0
+        self.synced = time.monotonic()
+
+    def flush(self):
+        """
+        fsync the lines recorded so far.
+        """
+        with self.lock:
+            self._fsync()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None and not self.file.closed:
+                self._fsync()
+                self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        return f"Journal({self.path!r}, {len(self.steps)} VMs)"
+
+def open_journal(journal: Union[str, 'Journal', None], readonly: bool = False) -> Union['Journal', None]:
+    """
+    Return a Journal for a path, a Journal or None as is.
+    """
+    return Journal(journal, readonly=readonly) if isinstance(journal, (str, os.PathLike)) else journal
+
+# Item keys restored from the journal for every pipeline stage, the quota stage journals each resource itself
+JOURNAL_KEYS = {
+    'resolve': ('vm_href',),
+    'snapshot': ('hardware', 'tags', 'desc'),
+    'service': ('service_href', 'service_tags', 'owner'),
+    'tags': ('tag_sync',),
+}
+
+# Item keys a pipeline stage depends on, a journaled step is redone when one of them changed
+JOURNAL_INPUTS = {
+    'resolve': ('state',),
+    'snapshot': ('vm_href',),
+    'service': (),
+    'tags': ('vm_href', 'service_href', 'location', 'vmtype', 'description'),
+}
+
+def journaled(step: str, func, journal: Journal):
+    """
+    Wrap a pipeline stage function so it skips items whose step is in the journal with the same
+    JOURNAL_INPUTS, and records the completed ones. The keys of JOURNAL_KEYS are restored into
+    skipped items and recorded for completed ones.
+    """
+    keys = JOURNAL_KEYS.get(step, ())
+
+    @functools.wraps(func)
+    def wrapper(item):
+        inputs = {k: item.get(k) or '' for k in JOURNAL_INPUTS.get(step, ())}
+        data = journal.done(item['vm_name'], step, inputs)
+        if data is not None:
+            item.update(data)
+            item.setdefault('resumed', []).append(step)
+            return item
+
+        item = func(item)
+        if item is not None and not item.get('error'):
+            journal.record(item['vm_name'], step, {k: item[k] for k in keys if k in item}, inputs=inputs)
+        return item
+
+    return wrapper
+
+# MANIFEST pipeline: streaming staged reconcile of a vMotion wave from a CSV/XLSX manifest
+
+# Workers per pipeline stage
+PIPELINE_WORKERS = {'resolve': 8, 'snapshot': 8, 'service': 4, 'quota': 8, 'tags': 4}
+
+# Sentinel telling a stage worker to stop
+_STOP = object()
+
+def read_manifest(path: str, chunksize: int = 500):
+    """
+    Stream the rows of a migration manifest in chunks.
+
+    CSV files are read chunk by chunk with pandas. XLSX files cannot be read in chunks by pandas,
+    the sheet is loaded once and yielded in chunks.
+    Column names are normalized, e.g. 'VM Name' -> 'vm_name' and 'name' is accepted for 'vm_name'.
+
+    Args:
+        path (str): Manifest path with the columns vm_name, location, vmtype and tenant
+                    and optional state, description and quota ('add', 'sub' or 'skip').
+        chunksize (int): Number of rows per chunk.
+
+    Yields:
+        dict: One dictionary per manifest row.
+    """
+    if str(path).lower().endswith(('.xlsx', '.xls')):
+        frame = pd.read_excel(path, dtype=str)
+        chunks = (frame.iloc[i:i + chunksize] for i in range(0, len(frame), chunksize))
+    else:
+        chunks = pd.read_csv(path, dtype=str, chunksize=chunksize)
+
+    for chunk in chunks:
+        chunk = chunk.rename(columns=lambda c: str(c).strip().lower().replace(' ', '_')).rename(columns={'name': 'vm_name'})
+        chunk = chunk.dropna(subset=['vm_name']).fillna('')
+
+        for row in chunk.to_dict('records'):
+            yield {k: str(v).strip() for k, v in row.items()}
+
+class Stage:
+    """
+    A pipeline stage: a bounded input queue served by its own pool of workers.
+
+    A full queue blocks the stage before it, so a slow stage slows down the whole pipeline
+    (backpressure) instead of letting queued rows pile up in memory.
+
+    Args:
+        name (str): Stage name.
+        func (callable): Function called with an item, returns the item for the next stage or None to drop it.
+        workers (int): Number of worker threads.
+        queue_size (int): Maximum number of items waiting for the stage.
+    """
+
+    def __init__(self, name: str, func, workers: int = 1, queue_size: int = 100):
+        self.name = name
+        self.func = func
+        self.workers = max(1, int(workers))
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.stats = {'processed': 0, 'failed': 0, 'busy_s': 0.0, 'max_queue': 0}
+        self.started = None
+        self.finished = None
+
+    def put(self, item):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        with self.lock:
+            self.stats['max_queue'] = max(self.stats['max_queue'], depth)
+
+    def throughput(self) -> float:
+        """
+        Return the number of items processed per second since the stage started.
+        """
+        if self.started is None:
+            return 0.0
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        return self.stats['processed'] / elapsed if elapsed > 0 else 0.0
+
+def run_pipeline(items, stages: list, deadline: float = None, progress: float = 10.0) -> pd.DataFrame:
+    """
+    Push items through the stages, every stage running its own workers in parallel with the others.
+
+    Args:
+        items (iterable): Items for the first stage, e.g. read_manifest(path).
+        stages (list): Stage objects in order.
+        deadline (float): Time budget in seconds for every stage call of an item, see Deadline.
+        progress (float): Print the stage throughput every so many seconds, 0 disables it.
+
+    Returns:
+        pd.DataFrame: Throughput report with one row per stage.
+    """
+    results = []
+    done = threading.Event()
+
+    def worker(index):
+        stage = stages[index]
+        following = stages[index + 1] if index + 1 < len(stages) else None
+
+        while True:
+            item = stage.queue.get()
+            if item is _STOP:
+                break
+
+            start = time.perf_counter()
+            try:
+                with profile_vm(item.get('vm_name')):
+                    if deadline is None:
+                        item = stage.func(item)
+                    else:
+                        with Deadline(deadline):
+                            item = stage.func(item)
+                failed = False
+            except Exception as e:
+                print(f"Stage {stage.name} failed for {color.BLUE}{item.get('vm_name')}{color.END}: {color.RED}{e}{color.END}")
+                item['error'] = f"{stage.name}: {e}"
+                failed = True
+
+            with stage.lock:
+                stage.stats['busy_s'] += time.perf_counter() - start
+                stage.stats['failed' if failed else 'processed'] += 1
+
+            if item is None:
+                continue
+            if failed or item.get('error') or following is None:
+                results.append(item)
+            else:
+                following.put(item)
+
+    def monitor():
+        while not done.wait(progress):
+            print(" | ".join(f"{stage.name}: {stage.stats['processed']} done {stage.throughput():.1f}/s queue {stage.queue.qsize()}" for stage in stages))
+
+    threads = []
+    for index, stage in enumerate(stages):
+        stage.started = time.perf_counter()
+        threads.append([threading.Thread(target=run_in_context(worker), args=(index,), name=f"miq-{stage.name}-{n}", daemon=True)
+                        for n in range(stage.workers)])
+        for thread in threads[-1]:
+            thread.start()
+
+    if progress:
+        threading.Thread(target=monitor, name='miq-monitor', daemon=True).start()
+
+    try:
+        # Blocks when the first stage is full
+        for item in items:
+            stages[0].put(item)
+    finally:
+        # Stop the stages in order, a stage stops after everything before it drained into it
+        for stage, stage_threads in zip(stages, threads):
+            for _ in stage_threads:
+                stage.queue.put(_STOP)
+            for thread in stage_threads:
+                thread.join()
+            stage.finished = time.perf_counter()
+        done.set()
+
+    report = pd.DataFrame([{'stage': stage.name, 'workers': stage.workers, **stage.stats, 'per_second': round(stage.throughput(), 2)}
+                           for stage in stages])
+    report.attrs['items'] = results
+
+    print(report.to_string(index=False))
+    return report
+
+def _vm_href(result) -> str:
+    # get_vm_url returns (url, data[, urls without service]), 1 or None
+    return result[0] if isinstance(result, tuple) else None
+
+def reconcile_resolve(item: dict, api_url: str = api_url, session: requests.Session = session, prefetcher: Prefetcher = None) -> dict:
+    """
+    Pipeline stage: resolve the VM href from its name with get_vm_url.
+    With a prefetcher the service, owner and tenant requests of the later stages start right away
+    and the VM requests as soon as the href is known.
+    """
+    if prefetcher is not None:
+        prefetcher.prefetch(vm_name=item['vm_name'], tenant=item.get('tenant') if (item.get('quota') or 'add').lower() != 'skip' else None)
+
+    item['vm_href'] = item.get('vm_href') or _vm_href(get_vm_url(item['vm_name'], item.get('state') or 'on', api_url=api_url, session=session))
+    if not item['vm_href']:
+        item['error'] = 'resolve: VM not found'
+    elif prefetcher is not None:
+        prefetcher.prefetch(vm_href=item['vm_href'])
+    return item
+
+def reconcile_snapshot(item: dict, session: requests.Session = session) -> dict:
+    """
+    Pipeline stage: read hardware and tags of the VM.
+    """
+    hardware = get_vm_hardware(item['vm_href'], session=session)
+    if hardware is None:
+        item['error'] = 'snapshot: hardware not available'
+        return item
+
+    item['hardware'] = {k: hardware[k] for k in ('cpu', 'memory', 'size')}
+    vm_tags = get_vm_tags(item['vm_href'], session=session)
+    item['tags'] = vm_tags['tags']
+    item['desc'] = vm_tags['desc']
+    return item
+
+def reconcile_service(item: dict, api_url: str = api_url, session: requests.Session = session) -> dict:
+    """
+    Pipeline stage: find the VM service, its tags and owner.
+    """
+    service = get_service_url_tags(item['vm_name'], api_url=api_url, session=session)
+    if isinstance(service, dict) and service.get('url'):
+        item['service_href'] = service['url']
+        item['service_tags'] = tags_to_dict(service['tags'])
+        item['owner'] = service.get('user')
+    return item
+
+def reconcile_quota(item: dict, api_url: str = api_url, session: requests.Session = session, journal: Journal = None) -> dict:
+    """
+    Pipeline stage: add the VM hardware to the tenant quota ('quota' column 'sub' subtracts, 'skip' skips it).
+    With a journal every quota resource is updated and recorded on its own, so a resumed run
+    applies only the deltas that were not applied yet, and the tenant quota hrefs are reused.
+    A delta recorded for another tenant, operation or amount is applied again.
+    """
+    operation = (item.get('quota') or 'add').lower()
+    if not item.get('tenant') or operation == 'skip':
+        return item
+
+    hardware = item['hardware']
+    if journal is None:
+        quota = get_tenant_quota(get_tenant_uri(item['tenant'], api_url=api_url, session=session), session=session)
+        item['quota_result'] = update_quota(quota, cpu=hardware['cpu'], memory=hardware['memory'], storage=hardware['size'],
+                                            operation=operation, session=session)
+        return item
+
+    tenant = f"tenant:{item['tenant']}"
+    quota = journal.done(tenant, 'quota_uris')
+    if quota is None:
+        quota = get_tenant_quota(get_tenant_uri(item['tenant'], api_url=api_url, session=session), session=session)
+        journal.record(tenant, 'quota_uris', quota)
+
+    item['quota_result'] = []
+    for resource, amount in (('cpu', hardware['cpu']), ('memory', hardware['memory']), ('storage', hardware['size'])):
+        step = f"quota:{resource}"
+        if not amount:
+            continue
+        inputs = {'tenant': item['tenant'], 'operation': operation, 'amount': amount, 'href': quota[resource][f"{resource}_uri"]}
+        if journal.done(item['vm_name'], step, inputs) is not None:
+            item.setdefault('resumed', []).append(step)
+            continue
+
+        written = update_quota({resource: quota[resource]}, operation=operation, session=session, **{resource: amount})
+        if not written or not all(r.ok for r in written):
+            item['error'] = f"quota: {resource} update failed"
+            break
+
+        item['quota_result'] += written
+        journal.record(item['vm_name'], step, inputs=inputs, sync=True)
+    return item
+
+def reconcile_tags(item: dict, session: requests.Session = session) -> dict:
+    """
+    Pipeline stage: synchronise location and vmtype tags of the VM and its service and update the description.
+    """
+    wanted = {category: item[category] for category in ('location', 'vmtype') if item.get(category)}
+    desired = {item['vm_href']: wanted}
+    current = {item['vm_href']: item.get('tags', {})}
+
+    if item.get('service_href'):
+        desired[item['service_href']] = wanted
+        current[item['service_href']] = item.get('service_tags', {})
+
+    item['tag_sync'] = sync_tags(desired, current=current, session=session)
+
+    if item.get('description') and item['description'] != item.get('desc'):
+        update_description(item['vm_href'], item['description'], session=session)
+
+    if item['tag_sync']['failed']:
+        item['error'] = f"tags: failed for {', '.join(item['tag_sync']['failed'])}"
+    return item
+
+def run_manifest(path: str, workers: dict = None, queue_size: int = 100, chunksize: int = 500, deadline: float = None,
+                 prefetch: bool = True, journal: Union[str, Journal] = None, api_url: str = api_url,
+                 session: requests.Session = session) -> pd.DataFrame:
+    """
+    Reconcile every VM of a migration manifest with the staged pipeline
+    resolve URL -> snapshot -> service/owner -> quota -> tag/description writes.
+
+    Args:
+        path (str): CSV or XLSX manifest, see read_manifest.
+        workers (dict): Workers per stage, merged with PIPELINE_WORKERS.
+        queue_size (int): Maximum number of rows waiting in front of every stage.
+        chunksize (int): Number of manifest rows read at a time.
+        deadline (float): Time budget in seconds for every stage of a VM, see Deadline.
+        prefetch (bool): Prefetch the requests of the later stages, see Prefetcher. Ignored when the
+                         session has no response cache, as the prefetched responses could not be reused.
+        journal (Union[str, Journal]): Checkpoint journal path or Journal. Steps recorded in it by an
+                                       interrupted run are skipped, see Journal.
+        api_url (str): The api endpoint url in the format 'https://manageiq.test.com/api'
+        session (requests.Session): The session object.
+
+    Returns:
+        pd.DataFrame: Throughput report per stage, with the processed rows in report.attrs['items'].
+    """
+    workers = {**PIPELINE_WORKERS, **(workers or {})}
+    if prefetch and getattr(session, 'cache', None) is None:
+        print(color.WARNING + "The session has no response cache, prefetching is disabled." + color.END)
+        prefetch = False
+
+    prefetcher = Prefetcher(api_url=api_url, session=session) if prefetch else None
+    journal_ = open_journal(journal)
+    functions = {
+        'resolve': functools.partial(reconcile_resolve, api_url=api_url, session=session, prefetcher=prefetcher),
+        'snapshot': functools.partial(reconcile_snapshot, session=session),
+        'service': functools.partial(reconcile_service, api_url=api_url, session=session),
+        'quota': functools.partial(reconcile_quota, api_url=api_url, session=session, journal=journal_),
+        'tags': functools.partial(reconcile_tags, session=session),
+    }
+    if journal_ is not None:
+        functions = {name: func if name == 'quota' else journaled(name, func, journal_) for name, func in functions.items()}
+    stages = [Stage(name, func, workers[name], queue_size) for name, func in functions.items()]
+
+    try:
+        report = run_pipeline(read_manifest(path, chunksize), stages, deadline=deadline)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        if journal_ is not None and journal_ is not journal:
+            journal_.close()
+
+    failed = [item for item in report.attrs['items'] if item and item.get('error')]
+    print(f"Manifest {color.BLUE}{path}{color.END}: {color.GREEN}{len(report.attrs['items']) - len(failed)}{color.END} VMs reconciled, {color.RED}{len(failed)}{color.END} failed")
+    if journal_ is not None:
+        print(f"Journal {color.BLUE}{journal_.path}{color.END}: {color.YELLOW}{journal_.stats['skipped']}{color.END} entries reused, {journal_.stats['recorded']} recorded")
+    for item in failed:
+        print(f"{color.BOLD}{item.get('vm_name')}{color.END} - {color.RED}{item['error']}{color.END}")
+
+    return report
+
+# VERIFICATION report after a wave
+
+# Fields compared by verify_migration, numeric ones with a tolerance
+VERIFY_NUMERIC = ('cpu', 'memory', 'size')
+VERIFY_TEXT = ('location', 'vmtype', 'description', 'service_name', 'owner')
+
+@deadline_aware
+def read_collection(url: str, attributes: str = '', limit: int = 1000, session: requests.Session = session) -> list:
+    """
+    Read every resource of a collection page by page.
+
+    Parameters:
+    - url (str): Collection url, optionally with filters, e.g. '.../api/vms?filter[]=power_state!=unknown'.
+    - attributes (str): Attributes to expand, e.g. 'name,tags'.
+    - limit (int): Number of resources per page.
+    - session (requests.Session): The session object.
+
+    Returns:
+    - list: Resource dictionaries.
+    """
+    resources = []
+    separator = '&' if '?' in url else '?'
+
+    while True:
+        page_url = f"{url}{separator}expand=resources&attributes={attributes}&offset={len(resources)}&limit={limit}"
+        response = session.get(page_url)
+        response.raise_for_status()
+
+        page = response.json().get('resources', [])
+        resources.extend(page)
+        if len(page) < limit:
+            return resources
+
+def snapshot_frame(items: list) -> pd.DataFrame:
+    """
+    Build the pre-migration snapshot for verify_migration from the items processed by run_manifest.
+
+    Parameters:
+    - items (list): Items from report.attrs['items'] of run_manifest.
+
+    Returns:
+    - pd.DataFrame: One row per VM with vm_name, vm_href, cpu, memory, size, location, vmtype, description and owner.
+    """
+    rows = []
+    for item in items:
+        if not item or item.get('error'):
+            continue
+        owner = item.get('owner') or [None, None]
+        rows.append({'vm_name': item['vm_name'], 'vm_href': item.get('vm_href'), **item.get('hardware', {}),
+                     'location': item.get('location'), 'vmtype': item.get('vmtype'),
+                     'description': item.get('description') or item.get('desc'), 'owner': owner[1] or owner[0]})
+
+    return pd.DataFrame(rows)
+
+def _id_strings(values: list, index=None) -> pd.Series:
+    # Ids as strings, read element by element before pandas upcasts them: 5, 5.0 and '5' all become '5'
+    def normalize(value):
+        if value is None or (isinstance(value, float) and np.isnan(value)):
+            return None
+        if isinstance(value, float) and value.is_integer():
+            return str(int(value))
+        return str(value)
+
+    return pd.Series([normalize(v) for v in values], index=index, dtype='string')
+
+def _post_migration_state(vms: list, users: list) -> pd.DataFrame:
+    # One row per VM with the same columns as the snapshot, built with vectorized operations
+    frame = pd.DataFrame(vms).reindex(columns=['href', 'name', 'description', 'power_state', 'hardware', 'disks', 'tags', 'service'])
+    state = pd.DataFrame({'vm_href': frame['href'], 'vm_name': frame['name'].astype(str), 'power_state': frame['power_state'],
+                          'actual_description': frame['description']})
+
+    hardware = pd.json_normalize(frame['hardware'].apply(lambda h: h if isinstance(h, dict) else {}).tolist())
+    state['actual_cpu'] = pd.to_numeric(hardware.get('cpu_total_cores'), errors='coerce')
+    state['actual_memory'] = pd.to_numeric(hardware.get('memory_mb'), errors='coerce') / 1024.0
+
+    # Disks: one row per disk, sum of device_type 'disk' per VM
+    disks = frame[['href', 'disks']].explode('disks').dropna(subset=['disks'])
+    disks = pd.DataFrame(disks['disks'].tolist(), index=disks.index).assign(href=disks['href'])
+    if 'device_type' in disks and 'size' in disks:
+        disks = disks[disks['device_type'] == 'disk']
+        size = pd.to_numeric(disks['size'], errors='coerce').groupby(disks['href']).sum() / (1024 * 1024 * 1024.0)
+        state['actual_size'] = state['vm_href'].map(size).fillna(0.0)
+    else:
+        state['actual_size'] = 0.0
+
+    # Tags: '/managed/<category>/<value>' -> one column per category
+    tags = frame[['href', 'tags']].explode('tags').dropna(subset=['tags'])
+    names = pd.Series([t.get('name', '') for t in tags['tags']], index=tags.index, dtype=str)
+    parts = names.str.replace('/managed/', '', regex=False).str.split('/', n=2, expand=True)
+    for category in ('location', 'vmtype'):
+        if parts.empty or parts.shape[1] < 2:
+            state[f'actual_{category}'] = None
+            continue
+        values = parts.loc[parts[0] == category, 1].groupby(tags.loc[parts[0] == category, 'href']).first()
+        state[f'actual_{category}'] = state['vm_href'].map(values)
+
+    # Service name and owner
+    service = frame['service'].apply(lambda x: x if isinstance(x, dict) else {})
+    state['actual_service_name'] = service.str.get('name')
+    owner_id = _id_strings([s.get('evm_owner_id') for s in service], index=state.index)
+
+    users = pd.DataFrame(users).reindex(columns=['id', 'name', 'email'])
+    users['id'] = _id_strings(users['id'].tolist(), index=users.index)
+    users = users.set_index('id')
+    state['owner_id'] = owner_id
+    state['owner_email'] = owner_id.map(users['email'])
+    state['owner_name'] = owner_id.map(users['name'])
+    state['actual_owner'] = state['owner_email'].fillna(state['owner_name']).fillna(owner_id)
+
+    return state
+
+def verify_migration(snapshot: Union[str, pd.DataFrame], api_url: str = api_url, session: requests.Session = session,
+                     report_path: str = None) -> pd.DataFrame:
+    """
+    Verify that every VM ended up with the expected hardware, tags, description, service name and owner.
+
+    The post-migration state is read with a few paged collection queries (or batched 'query'
+    actions when the snapshot has vm_href), loaded into DataFrames and compared with the snapshot
+    using vectorized joins, so the whole wave is checked without per-VM requests.
+
+    Args:
+        snapshot (str or pd.DataFrame): Pre-migration snapshot (CSV path or DataFrame, see snapshot_frame)
+            with vm_name and any of cpu, memory, size, location, vmtype, description, service_name and owner.
+            service_name defaults to "VM - NAME".
+        api_url (str): The api endpoint url in the format 'https://manageiq.test.com/api'
+        session (requests.Session): The session object.
+        report_path (str): Optional CSV path for the mismatch report.
+
+    Returns:
+        pd.DataFrame: Mismatch report with vm_name, field, expected and actual columns.
+    """
+    expected = pd.read_csv(snapshot, dtype={'vm_name': str}) if isinstance(snapshot, str) else snapshot.copy()
+    expected = expected.dropna(subset=['vm_name'])
+    if 'service_name' not in expected:
+        expected['service_name'] = "VM - " + expected['vm_name'].str.upper()
+
+    attributes = 'name,description,power_state,hardware,disks,tags,service'
+    if 'vm_href' in expected and expected['vm_href'].notna().all():
+        vms = list(bulk_query(expected['vm_href'].tolist(), attributes, session=session).values())
+    else:
+        vms = read_collection(f"{api_url}/vms", attributes, session=session)
+    users = read_collection(f"{api_url}/users", 'id,name,email', session=session) if 'owner' in expected else []
+
+    actual = _post_migration_state(vms, users)
+    # Archived VMs keep the old name, only the live VM is verified
+    actual = actual[actual['power_state'] != 'unknown']
+
+    expected['key'] = expected['vm_name'].str.strip().str.lower()
+    actual = actual.assign(key=actual['vm_name'].str.strip().str.lower()).drop_duplicates('key')
+    merged = expected.merge(actual.drop(columns=['vm_name']), on='key', how='left', indicator=True)
+
+    mismatches = [pd.DataFrame({'vm_name': merged.loc[merged['_merge'] == 'left_only', 'vm_name'], 'field': 'vm',
+                                'expected': 'present', 'actual': 'missing'})]
+    found = merged[merged['_merge'] == 'both']
+
+    for field in VERIFY_NUMERIC + VERIFY_TEXT:
+        if field not in found or f'actual_{field}' not in found:
+            continue
+
+        want, got = found[field], found[f'actual_{field}']
+        if field in VERIFY_NUMERIC:
+            want, got = pd.to_numeric(want, errors='coerce'), pd.to_numeric(got, errors='coerce')
+            wrong = ~np.isclose(want, got, atol=0.01, equal_nan=True)
+        elif field == 'owner':
+            owner = want.astype(str).str.strip().str.lower()
+            wrong = ~(owner.eq(found['owner_email'].astype(str).str.lower()) | owner.eq(found['owner_name'].astype(str).str.lower())
+                      | owner.eq(found['owner_id'].astype(str)))
+        else:
+            wrong = want.fillna('').astype(str).str.strip().str.lower() != got.fillna('').astype(str).str.strip().str.lower()
+
+        wrong &= want.notna()
+        mismatches.append(pd.DataFrame({'vm_name': found.loc[wrong, 'vm_name'], 'field': field,
+                                        'expected': want[wrong], 'actual': got[wrong]}))
+
+    report = pd.concat(mismatches, ignore_index=True)
+
+    print(f"Verified {color.BOLD}{len(expected)}{color.END} VMs: {color.GREEN}{len(expected) - report['vm_name'].nunique()}{color.END} OK, "
+          f"{color.RED}{report['vm_name'].nunique()}{color.END} with mismatches")
+    for field, count in report['field'].value_counts().items():
+        print(f"{field}: {color.RED}{count}{color.END}")
+
+    if report_path:
+        report.to_csv(report_path, index=False)
+        print(f"Mismatch report written: {color.BLUE}{report_path}{color.END}")
+
+    return report
+
+# DRY-RUN planner: planned requests of a wave and their estimated cost
+
+# Latency and sizes assumed for endpoints without measurements
+PLAN_DEFAULT_COST = {'latency_s': 0.25, 'response_bytes': 4096, 'request_bytes': 256}
+
+def request_costs(cassettes: list = (), session: requests.Session = session) -> pd.DataFrame:
+    """
+    Measured cost of the requests per method and endpoint (see endpoint_key).
+
+    Args:
+        cassettes (list): Cassette paths recorded with record() or 'run --record'.
+        session (MIQSession): Session whose timings of this run are added to the cassettes.
+
+    Returns:
+        pd.DataFrame: One row per method and endpoint with the number of samples, median and p90 latency
+                      and median response and request bytes.
+    """
+    samples = []
+    for path in cassettes or ():
+        for entry in Cassette.load(path).entries:
+            samples.append((entry['m'], endpoint_key(entry['u']), entry['t'], len(entry['c'] or ''), len(entry['b'] or '')))
+
+    timings = getattr(session, 'timings', None) or {}
+    with getattr(session, 'inflight_lock', threading.Lock()):
+        for (method, endpoint), values in timings.items():
+            samples += [(method, endpoint, *sample) for sample in values]
+
+    columns = ['method', 'endpoint', 'latency_s', 'response_bytes', 'request_bytes']
+    frame = pd.DataFrame(samples, columns=columns).astype({'latency_s': float, 'response_bytes': float, 'request_bytes': float})
+    grouped = frame.groupby(['method', 'endpoint'])
+
+    return pd.DataFrame({
+        'samples': grouped.size(),
+        'latency_s': grouped['latency_s'].median(),
+        'p90_s': grouped['latency_s'].quantile(0.9),
+        'response_bytes': grouped['response_bytes'].median(),
+        'request_bytes': grouped['request_bytes'].median(),
+    }).reset_index()
+
+class _Plan:
+    """
+    Planned requests of a dry run, with what is already known about their responses.
+
+    Responses are looked up in the session response cache (stale entries included) and in the
+    cassettes, so the branches they decide can be followed without asking the API.
+    """
+
+    def __init__(self, api_url: str, session: requests.Session, cassettes: list = (), journal: 'Journal' = None):
+        self.api_url = api_url
+        self.cache = getattr(session, 'cache', None)
+        self.journal = journal
+        self.rows = []
+        self.recorded = {}
+        for path in cassettes or ():
+            for entry in Cassette.load(path).entries:
+                if entry['m'] == 'GET' and entry['s'] == 200:
+                    self.recorded[entry['u']] = entry['c']
+
+    def known(self, url: str):
+        # Decoded response of a GET url when the cache or a cassette has it, otherwise None
+        entry = self.cache.get(url) if self.cache is not None else None
+        try:
+            if entry is not None:
+                return entry.response.json()
+            # Cassettes keep the urls as sent, i.e. percent-encoded
+            recorded = self.recorded.get(_scrub_url(requests.Request('GET', url).prepare().url))
+            if recorded is not None:
+                return json.loads(recorded)
+        except ValueError:
+            pass
+        return None
+
+    def add(self, item: dict, stage: str, method: str, url: str, likely: bool = True, branch: str = 'primary',
+            resolved: bool = True, cacheable: bool = True, target: str = None):
+        entry = self.cache.get(url) if self.cache is not None and method == 'GET' and cacheable and resolved else None
+        self.rows.append({'vm_name': item['vm_name'], 'stage': stage, 'method': method, 'url': url,
+                          'endpoint': endpoint_key(url), 'branch': branch, 'likely': likely, 'resolved': resolved,
+                          'cacheable': method == 'GET' and cacheable, 'cached': entry is not None and entry.fresh(),
+                          'target': target})
+
+    def done(self, item: dict, step: str, inputs: dict = None, **known):
+        # Journaled data of a step; pipeline steps are matched on their JOURNAL_INPUTS, taken from known before item
+        if self.journal is None:
+            return None
+        if step in JOURNAL_INPUTS:
+            inputs = {k: (known[k] if k in known else item.get(k)) or '' for k in JOURNAL_INPUTS[step]}
+        return self.journal.done(item['vm_name'], step, inputs)
+
+def _match_name(resources: list, name: str, prefix: str = ''):
+    # Href of the exact case-insensitive name match, else of the shortest name containing it, like the fallbacks of get_vm_url/get_service_url_tags
+    candidates = [r for r in resources if str(r.get('name')).startswith(prefix) and str(name).lower() in str(r.get('name')).lower()]
+    exact = [r for r in candidates if len(str(r['name'])) == len(prefix + str(name))]
+    best = exact or sorted(candidates, key=lambda r: len(str(r['name'])))
+    return best[0]['href'] if best else False
+
+def _plan_lookup(plan: _Plan, item: dict, stage: str, urls: list, listing: str = None, prefix: str = '',
+                 svc_check: str = None, ambiguous: bool = False):
+    """
+    Plan the chain of name lookups of get_vm_url or get_service_url_tags, every url being a fallback of the previous one.
+
+    Returns the found href, False when the responses show there is nothing to find and None when unknown.
+    """
+    likely = True
+    for n, url in enumerate(urls):
+        branch = 'primary' if n == 0 else 'fallback'
+        plan.add(item, stage, 'GET', url, likely, branch)
+        data = plan.known(url)
+        if data is None:
+            likely = False
+            continue
+
+        resources = data.get('resources') or []
+        if not resources:
+            continue
+
+        # Several VMs with the same name are checked for a service one by one
+        if svc_check == 'all' or (svc_check == 'many' and len(resources) > 1):
+            for resource in resources:
+                plan.add(item, stage, 'GET', f"{resource['href']}?expand=resources&attributes=service", likely, branch)
+        if ambiguous and len(resources) > 1:
+            return False if likely else None
+        return resources[0]['href'] if likely else None
+
+    if listing:
+        plan.add(item, stage, 'GET', listing, likely, 'fallback')
+        data = plan.known(listing)
+        if data is not None and likely:
+            return _match_name(data.get('resources') or [], item['vm_name'], prefix)
+
+    return False if likely else None
+
+def _plan_resolve(plan: _Plan, item: dict):
+    name = str(item['vm_name'])
+    state = (item.get('state') or 'on').lower()
+    vms_url = f"{plan.api_url}/vms"
+
+    if state == 'archived':
+        urls = [f"{vms_url}?filter[]=name='{n}'&filter[]=power_state='unknown'" for n in (name, name.lower(), name.upper())]
+        return _plan_lookup(plan, item, 'resolve', urls, svc_check='all')
+
+    if state not in ('on', 'off'):
+        return False
+
+    forms = [(name, state), (name.lower(), state)] + ([(name, 'off'), (name.lower(), 'off')] if state == 'on' else [])
+    urls = [f"{vms_url}?filter[]=name='{n}'&filter[]=power_state='{s}'" for n, s in forms]
+    listing = f"{vms_url}?expand=resources&attributes=name,power_state" + ("='off'" if state == 'off' else '')
+    return _plan_lookup(plan, item, 'resolve', urls, listing, svc_check='many' if state == 'on' else None)
+
+def _plan_service(plan: _Plan, item: dict):
+    name = str(item['vm_name'])
+    services_url = f"{plan.api_url}/services"
+    urls = [f"{services_url}?filter[]=name='VM - {name}'", f"{services_url}?filter[]=name='VM - {name.upper()}'",
+            f"{services_url}?expand=resources&attributes=name&filter[]=name='*{name}'"]
+    href = _plan_lookup(plan, item, 'service', urls, f"{services_url}?expand=resources&attributes=name", prefix='VM - ', ambiguous=True)
+    if href is False:
+        return False, None
+
+    service_url = f"{href or services_url + '/:id'}?expand=tags"
+    plan.add(item, 'service', 'GET', service_url, resolved=href is not None)
+
+    data = plan.known(service_url) if href else None
+    owner = (data or {}).get('evm_owner_id')
+    plan.add(item, 'service', 'GET', f"{plan.api_url}/users/{owner or ':id'}", resolved=bool(owner))
+    return href, data
+
+def _hardware(data: dict):
+    # cpu, memory and size of a VM like get_vm_hardware
+    if not data or not data.get('hardware'):
+        return None
+    size = sum(int(d['size']) for d in data.get('disks') or [] if d.get('device_type') == 'disk')
+    return {'cpu': data['hardware'].get('cpu_total_cores'), 'memory': int(data['hardware'].get('memory_mb') or 0) / 1024.0,
+            'size': size / (1024 * 1024 * 1024.0)}
+
+def _plan_vm(plan: _Plan, item: dict):
+    """
+    Plan the requests of the manifest pipeline stages for one VM, see run_manifest.
+    """
+    api = plan.api_url
+
+    # resolve
+    resolved = plan.done(item, 'resolve')
+    href = resolved['vm_href'] if resolved else _plan_resolve(plan, item)
+    if href is False:
+        item['error'] = 'resolve: VM not found'
+        return
+    vm_url = href or f"{api}/vms/:id"
+
+    # snapshot
+    snapshot = plan.done(item, 'snapshot', vm_href=href)
+    if snapshot is None:
+        hardware_url = f"{vm_url}?expand=resources&attributes=hardware,disks"
+        tags_url = f"{vm_url}?expand=resources&attributes=tags"
+        plan.add(item, 'snapshot', 'GET', hardware_url, resolved=bool(href))
+        plan.add(item, 'snapshot', 'GET', tags_url, resolved=bool(href))
+
+        tags_data = plan.known(tags_url) if href else None
+        snapshot = {'hardware': _hardware(plan.known(hardware_url) if href else None),
+                    'tags': tags_to_dict(tags_data['tags']) if tags_data else None,
+                    'desc': (tags_data or {}).get('description')}
+
+    # service
+    service = plan.done(item, 'service')
+    if service is not None:
+        service_href, service_tags = service.get('service_href') or False, service.get('service_tags')
+    else:
+        service_href, data = _plan_service(plan, item)
+        service_tags = tags_to_dict(data['tags']) if data else None
+
+    # quota
+    operation = (item.get('quota') or 'add').lower()
+    if item.get('tenant') and operation != 'skip':
+        uris = plan.done({'vm_name': f"tenant:{item['tenant']}"}, 'quota_uris')
+        if uris is None:
+            tenant_url = f"{api}/tenants?expand=resources&attributes=name&filter[]=name={str(item['tenant'])}"
+            plan.add(item, 'quota', 'GET', tenant_url)
+            tenant = (plan.known(tenant_url) or {}).get('resources') or [{}]
+            tenant_href = tenant[0].get('href')
+            quotas_url = f"{tenant_href or api + '/tenants/:id'}/quotas?expand=resources&attributes=name,value,unit,used,available,total"
+            plan.add(item, 'quota', 'GET', quotas_url, resolved=bool(tenant_href))
+
+            names = {'storage_allocated': 'storage', 'mem_allocated': 'memory', 'cpu_allocated': 'cpu'}
+            quotas = (plan.known(quotas_url) if tenant_href else None) or {}
+            uris = {names[q['name']]: {f"{names[q['name']]}_uri": q['href']} for q in quotas.get('resources') or [] if q.get('name') in names}
+
+        hardware = snapshot.get('hardware') or {}
+        for resource, amount in (('cpu', hardware.get('cpu')), ('memory', hardware.get('memory')), ('storage', hardware.get('size'))):
+            quota_href = (uris.get(resource) or {}).get(f"{resource}_uri")
+            inputs = {'tenant': item['tenant'], 'operation': operation, 'amount': amount, 'href': quota_href}
+            if (snapshot.get('hardware') and not amount) or plan.done(item, f"quota:{resource}", inputs) is not None:
+                continue
+            quota_url = quota_href or f"{api}/tenants/:id/quotas/:id"
+            # Re-read bypassing the cache, then the write, see _write_quota
+            plan.add(item, 'quota', 'GET', quota_url, resolved=bool(quota_href), cacheable=False)
+            plan.add(item, 'quota', 'POST', quota_url, resolved=bool(quota_href))
+
+    # tags and description
+    if plan.done(item, 'tags', vm_href=href, service_href=service_href) is None:
+        wanted = {category: item[category] for category in ('location', 'vmtype') if item.get(category)}
+        targets = [('vms', href, snapshot.get('tags'))] + ([('services', service_href, service_tags)] if service_href is not False else [])
+
+        # Unknown current tags are planned as a single assign_tags write, see sync_tags
+        for collection, target, current in targets:
+            if current is None:
+                plan.add(item, 'tags', 'POST', f"{api}/{collection}", target=target)
+                continue
+            current = {str(k).lower(): str(v).lower() for k, v in current.items()}
+            changed = [str(k).lower() for k, v in wanted.items() if current.get(str(k).lower()) != str(v).lower()]
+            if any(k in current for k in changed):
+                plan.add(item, 'tags', 'POST', f"{api}/{collection}", target=target)
+            if changed:
+                plan.add(item, 'tags', 'POST', f"{api}/{collection}", target=target)
+
+        if item.get('description') and item['description'] != snapshot.get('desc'):
+            plan.add(item, 'tags', 'POST', vm_url, resolved=bool(href))
+
+def _invalidated(plan: pd.DataFrame) -> pd.Series:
+    """
+    Mask of the planned GETs whose cached response is dropped by a planned write, see ResponseCache.invalidate.
+    """
+    roots, collections = set(), set()
+    for url, target in plan.loc[(plan['method'] != 'GET') & plan['resolved'], ['url', 'target']].itertuples(index=False):
+        root = _resource_root(url)
+        if not endpoint_key(root).endswith(':id'):
+            collections.add(root)
+            root = _resource_root(target) if target else None
+        if root:
+            roots.add(root)
+            collections.add(collection_url(root))
+
+    paths = plan['url'].str.split('?').str[0].str.rstrip('/')
+    return paths.isin(collections) | paths.map(lambda path: any(path == root or path.startswith(root + '/') for root in roots))
+
+def estimate_plan(plan: pd.DataFrame, costs: pd.DataFrame = None, concurrency: int = 8) -> dict:
+    """
+    Estimate requests, bytes and wall time of planned requests.
+
+    GETs of the same url are sent once (response cache and coalescing) unless a planned write
+    invalidates them, GETs served by a fresh cache entry are not sent at all. Latency and sizes come from the measured costs per method and
+    endpoint, falling back to the endpoint with any method, the median of all measurements and
+    PLAN_DEFAULT_COST. Wall time is the network time spread over the concurrent requests, but never
+    shorter than the slowest VM doing its requests one after the other.
+
+    Args:
+        plan (pd.DataFrame): Planned requests, see plan_manifest.
+        costs (pd.DataFrame): Measured costs, see request_costs.
+        concurrency (int): Number of requests in flight at the same time.
+
+    Returns:
+        dict: 'requests', 'gets', 'writes', 'deduplicated', 'cached', 'bytes', 'network_s' and 'wall_s'
+              for the likely branches, and 'worst_case_requests' and 'worst_case_wall_s' with every fallback.
+    """
+    if plan.empty:
+        return {'requests': 0, 'gets': 0, 'writes': 0, 'deduplicated': 0, 'cached': 0, 'bytes': 0, 'network_s': 0.0,
+                'wall_s': 0.0, 'worst_case_requests': 0, 'worst_case_wall_s': 0.0}
+
+    costs = costs if costs is not None and not costs.empty else pd.DataFrame(columns=['method', 'endpoint', *PLAN_DEFAULT_COST])
+    fields = list(PLAN_DEFAULT_COST)
+    default = {k: (costs[k].median() if len(costs) else v) for k, v in PLAN_DEFAULT_COST.items()}
+    by_endpoint = costs.groupby('endpoint')[fields].median()
+
+    frame = plan.merge(costs[['method', 'endpoint', *fields]], on=['method', 'endpoint'], how='left')
+    for field in fields:
+        frame[field] = frame[field].fillna(frame['endpoint'].map(by_endpoint[field]) if len(by_endpoint) else np.nan).fillna(default[field])
+    frame['request_bytes'] = frame['request_bytes'].where(frame['method'] != 'GET', 0)
+
+    frame['shared'] = frame['cacheable'] & frame['resolved'] & ~_invalidated(frame)
+
+    def totals(rows: pd.DataFrame) -> dict:
+        rows = rows[~rows['cached']]
+        shared = rows['shared']
+        duplicate = shared & rows.duplicated(subset=['method', 'url'])
+        sent = rows[~duplicate]
+        network_s = float(sent['latency_s'].sum())
+        slowest = float(rows.groupby('vm_name')['latency_s'].sum().max())
+        return {'requests': len(sent), 'gets': int((sent['method'] == 'GET').sum()), 'writes': int((sent['method'] != 'GET').sum()),
+                'deduplicated': int(duplicate.sum()), 'bytes': int((sent['response_bytes'] + sent['request_bytes']).sum()),
+                'network_s': round(network_s, 2), 'wall_s': round(max(network_s / max(1, concurrency), slowest), 2)}
+
+    estimate = totals(frame[frame['likely']])
+    worst = totals(frame)
+    estimate.update(cached=int((frame['likely'] & frame['cached']).sum()), worst_case_requests=worst['requests'], worst_case_wall_s=worst['wall_s'])
+    return estimate
+
+def plan_manifest(path: str, concurrency: int = None, cassettes: list = (), journal: Union[str, Journal] = None,
+                  report_path: str = None, api_url: str = api_url, session: requests.Session = session) -> pd.DataFrame:
+    """
+    Dry run of run_manifest: plan the exact GETs and writes of every VM without sending any request.
+
+    Lookups are followed through the fallback branches of get_vm_url and get_service_url_tags as far
+    as the session cache and the cassettes know the responses; branches that cannot be decided are
+    planned as unlikely. Steps recorded in the journal are left out, like in a resumed run.
+
+    Args:
+        path (str): CSV or XLSX manifest, see read_manifest.
+        concurrency (int): Requests in flight at the same time, by default the sum of PIPELINE_WORKERS.
+        cassettes (list): Cassettes with recorded responses and latencies, see record().
+        journal (Union[str, Journal]): Checkpoint journal of an interrupted run, see Journal.
+                                       A path is only read, a missing file plans a fresh run.
+        report_path (str): CSV path for the planned requests.
+        api_url (str): The api endpoint url in the format 'https://manageiq.test.com/api'
+        session (requests.Session): Session whose cache and timings are used.
+
+    Returns:
+        pd.DataFrame: Planned requests in order with the columns vm_name, stage, method, url, endpoint,
+                      branch, likely, resolved, cacheable, cached and target (href of a bulk write),
+                      and the estimate in attrs['estimate'].
+    """
+    concurrency = concurrency or sum(PIPELINE_WORKERS.values())
+    journal_ = open_journal(journal, readonly=True)
+    plan = _Plan(api_url, session, cassettes, journal_)
+    errors = {}
+
+    try:
+        for item in read_manifest(path):
+            _plan_vm(plan, item)
+            if item.get('error'):
+                errors[item['vm_name']] = item['error']
+    finally:
+        if journal_ is not None and journal_ is not journal:
+            journal_.close()
+
+    columns = ['vm_name', 'stage', 'method', 'url', 'endpoint', 'branch', 'likely', 'resolved', 'cacheable', 'cached', 'target']
+    frame = pd.DataFrame(plan.rows, columns=columns)
+    costs = request_costs(cassettes, session=session)
+    estimate = estimate_plan(frame, costs, concurrency)
+    frame.attrs['estimate'] = estimate
+
+    if report_path:
+        frame.to_csv(report_path, index=False)
+        print(f"Planned requests written: {color.BLUE}{report_path}{color.END}")
+
+    likely = frame[frame['likely']]
+    if not likely.empty:
+        print(likely.groupby(['method', 'endpoint']).size().rename('planned').reset_index().to_string(index=False))
+    for vm_name, error in errors.items():
+        print(f"{color.BOLD}{vm_name}{color.END} - {color.RED}{error}{color.END}")
+
+    print(f"Dry run {color.BLUE}{path}{color.END}: {color.BOLD}{frame['vm_name'].nunique()}{color.END} VMs, "
+          f"{color.BOLD}{estimate['requests']}{color.END} requests ({estimate['gets']} GET, {color.YELLOW}{estimate['writes']}{color.END} writes), "
+          f"{color.GREEN}{estimate['deduplicated']}{color.END} deduplicated, {color.GREEN}{estimate['cached']}{color.END} cached, "
+          f"{estimate['bytes'] / (1024 * 1024):.1f} MB, ~{timedelta(seconds=round(estimate['wall_s']))} at concurrency {concurrency} "
+          f"(worst case {estimate['worst_case_requests']} requests, ~{timedelta(seconds=round(estimate['worst_case_wall_s']))})")
+    if costs.empty:
+        print(color.WARNING + "No measured latencies, estimate uses PLAN_DEFAULT_COST. Pass a cassette recorded in a previous wave." + color.END)
+
+    return frame
+
+# COMMAND line
+
+class _Tee:
+    """
+    Write terminal output to the run log as well.
+    """
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+
+    def flush(self):
+        for stream in self.streams:
+            stream.flush()
+
+def main(argv: list = None):
+    """
+    Command line entry point, e.g. 'python MIQ_migrate.py --profile run wave.py'.
+    """
+    global RUN_LOG
+
+    parser = argparse.ArgumentParser(prog='MIQ_migrate.py', description='Update ManageIQ VM objects after Cross vCenter vMotion.')
+    parser.add_argument('--profile', action='store_true', help='profile API functions, see MIQ_PROFILE')
+    parser.add_argument('--log', default=RUN_LOG, help='run log path, profiling results are written next to it')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help='run a python script using MIQ_migrate functions')
+    run.add_argument('--record', metavar='CASSETTE', help='record the API traffic of the module session into a cassette')
+    run.add_argument('script')
+    run.add_argument('args', nargs=argparse.REMAINDER)
+
+    manifest = commands.add_parser('manifest', help='reconcile the VMs of a CSV/XLSX migration manifest')
+    manifest.add_argument('path')
+    manifest.add_argument('--workers', nargs='*', default=[], metavar='STAGE=N', help=f"workers per stage, stages: {', '.join(PIPELINE_WORKERS)}")
+    manifest.add_argument('--queue-size', type=int, default=100)
+    manifest.add_argument('--chunksize', type=int, default=500)
+    manifest.add_argument('--deadline', type=float, help='time budget in seconds for every stage of a VM')
+    manifest.add_argument('--no-prefetch', action='store_true', help='do not prefetch the requests of the later stages')
+    manifest.add_argument('--no-cache', action='store_true', help='do not cache GET responses, see MIQ_CACHE')
+    manifest.add_argument('--journal', metavar='JOURNAL', help='checkpoint journal of this run, a rerun with the same journal resumes it')
+    manifest.add_argument('--dry-run', action='store_true', help='only plan the requests and estimate their cost')
+    manifest.add_argument('--cassette', nargs='*', default=[], help='dry run: cassettes with recorded responses and latencies')
+    manifest.add_argument('--concurrency', type=int, help='dry run: requests in flight, default the sum of the stage workers')
+    manifest.add_argument('--report', help='dry run: CSV path for the planned requests')
+
+    verify = commands.add_parser('verify', help='compare the post-migration state with a pre-migration snapshot CSV')
+    verify.add_argument('snapshot')
+    verify.add_argument('--report', help='CSV path for the mismatch report')
+
+    bench = commands.add_parser('bench', help='replay a script against a cassette and compare it with a baseline')
+    bench.add_argument('--cassette', required=True)
+    bench.add_argument('--baseline', required=True)
+    bench.add_argument('--tolerance', type=float, default=0.1)
+    bench.add_argument('--speed', type=float, default=1.0, help='latency multiplier, 0 replays without waiting')
+    bench.add_argument('--update-baseline', action='store_true')
+    bench.add_argument('script')
+    bench.add_argument('args', nargs=argparse.REMAINDER)
+
+    options = parser.parse_args(argv)
+    RUN_LOG = options.log
+
+    # Scripts importing MIQ_migrate get this module (and its profiler) instead of a second copy
+    sys.modules.setdefault('MIQ_migrate', sys.modules[__name__])
+
+    if options.profile:
+        enable_profiling()
+
+    stdout = sys.stdout
+    with open(RUN_LOG, 'a') as log:
+        sys.stdout = _Tee(stdout, log)
+        try:
+            if options.command == 'manifest':
+                workers = {k: int(v) for k, v in (w.split('=', 1) for w in options.workers)}
+                journal = options.journal
+                if options.dry_run:
+                    plan_manifest(options.path, concurrency=options.concurrency or sum({**PIPELINE_WORKERS, **workers}.values()),
+                                  cassettes=options.cassette, journal=journal,
+                                  report_path=options.report)
+                    return
+                if session.cache is None and not options.no_cache:
+                    session.cache = ResponseCache()
+                run_manifest(options.path, workers=workers, queue_size=options.queue_size, chunksize=options.chunksize,
+                             deadline=options.deadline, prefetch=not options.no_prefetch, journal=journal)
+                return
+
+            if options.command == 'verify':
+                verify_migration(options.snapshot, report_path=options.report)
+                return
+
+            sys.argv = [options.script] + options.args
+            run_script = functools.partial(runpy.run_path, options.script, run_name='__main__')
+
+            if options.command == 'run' and options.record:
+                with record(options.record):
+                    run_script()
+            elif options.command == 'run':
+                run_script()
+            elif options.command == 'bench':
+                replay_benchmark(run_script, options.cassette, options.baseline, tolerance=options.tolerance,
+                                 update=options.update_baseline, speed=options.speed)
+        finally:
+            sys.stdout = stdout
+            if options.profile:
+                disable_profiling()
+
+# Profiling from the environment, once every function above is defined
+if os.environ.get('MIQ_PROFILE', '').lower() in ('1', 'true', 'yes'):
+    enable_profiling()
+    atexit.register(disable_profiling)
+
+if __name__ == '__main__':
+    main()